@@ -0,0 +1,293 @@
+#! /usr/bin/env python
+"""
+bench - benchmark madseq on synthetic MAD-X lattices.
+
+Usage:
+    bench.py [options]
+    bench.py generate [options] [<output>]
+    bench.py (--help | --version)
+
+Options:
+    -n <num>, --sequences=<num>     Number of sequences [default: 4]
+    -m <num>, --elements=<num>      Number of elements per sequence
+                                    [default: 5000]
+    -d <num>, --depth=<num>         Inheritance depth of the element
+                                    definitions [default: 2]
+    -a <num>, --args=<num>          Number of extra arguments per element
+                                    [default: 2]
+    -r <rules>, --rules=<rules>     Slicing rule style: density, slice,
+                                    makethin, template or loop
+                                    [default: slice]
+    -f <fmts>, --formats=<fmts>     Comma separated dump formats
+                                    [default: madx,json,yaml,binary]
+    --repeat=<num>                  Report the best time of this many runs
+                                    [default: 1]
+    --no-memory                     Do not measure the peak memory usage
+    -o <file>, --output=<file>      Write the report to this file
+    -h, --help                      Show this help
+    -v, --version                   Show version information
+
+Generates a lattice, runs it through the stages of madseq one by one and
+prints a JSON report with the time, throughput (input elements per second)
+and peak memory of each stage. The peak memory is measured with tracemalloc
+in a separate run, so that it does not affect the timings.
+
+With ``generate`` only the lattice is written (to stdout by default) and
+the slicing rules are printed to stderr as JSON.
+"""
+
+from __future__ import division
+
+import io
+import json
+import os
+import platform
+import sys
+import time
+
+# benchmark the madseq module of this checkout:
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import madseq
+
+
+__version__ = 'bench 0.1'
+
+formats = ('madx', 'json', 'yaml', 'binary')
+
+rule_styles = {
+    'density': {'density': 4},
+    'slice': {'slice': 4},
+    'makethin': {'slice': 4, 'makethin': True},
+    'template': {'slice': 4, 'template': True},
+    'loop': {'slice': 4, 'style': 'loop'},
+}
+
+# base types with the arguments of their root definition and the length of
+# the sequence elements:
+base_types = [
+    ('quadrupole', 'l=0.5, k1:=kq{0}', 0.5),
+    ('drift', 'l=1.2', 1.2),
+    ('sbend', 'l=1.5, angle=0.02, e1=0.01', 1.5),
+    ('sextupole', 'l=0.2, k2=1.25', 0.2),
+    ('multipole', 'knl={{0, 0.01}}', 0),
+    ('marker', 'apertype=circle', 0),
+]
+
+# value kinds used for the extra arguments of the elements:
+arg_values = [
+    '=0.{0}125',
+    '={0}',
+    ':=kq{0}*1.5',
+    '={{0.03, 0.0{0}}}',
+    '="tag{0}"',
+]
+
+
+def slicing(style):
+    """
+    Create the slicing rules for a rule style.
+
+    :param str style: one of :data:`rule_styles`
+    :returns: one rule per base type with non-zero length
+    :rtype: list
+    """
+    try:
+        rule = rule_styles[style]
+    except KeyError:
+        raise ValueError("Unknown rule style: {0!r}".format(style))
+    return [dict(rule, type=base) for base, _, length in base_types
+            if length]
+
+
+def generate(stream, sequences=4, elements=5000, depth=2, args=2):
+    """
+    Write a synthetic MAD-X lattice.
+
+    Each base type is defined once and derived ``depth-1`` times, each level
+    adding an argument. The sequences place elements of the most derived
+    types one after another, each with ``args`` extra arguments of mixed
+    value kinds (numbers, deferred expressions, arrays and strings).
+
+    :param stream: output file object
+    :param int sequences: number of sequences
+    :param int elements: number of elements per sequence
+    :param int depth: number of definition levels for each base type
+    :param int args: number of extra arguments per element
+    """
+    write = stream.write
+    write('! synthetic lattice: {0} x {1} elements, depth {2}, {3} args\n'
+          .format(sequences, elements, depth, args))
+    for i in range(sequences):
+        write('kq{0} = 0.{0}5;\n'.format(i))
+    write('\n')
+    for base, base_args, _ in base_types:
+        write('{0}0: {0}, {1};\n'.format(base, base_args.format(0)))
+        for level in range(1, depth):
+            write('{0}{1}: {0}{2}, kmax={1};\n'.format(base, level, level-1))
+    types = ['{0}{1}'.format(base, max(depth-1, 0))
+             for base, _, _ in base_types]
+    positions = []
+    length = 0
+    for j in range(elements):
+        positions.append(length)
+        length += base_types[j % len(types)][2] + 0.1
+    for i in range(sequences):
+        write('\nseq{0}: sequence, l={1:.4f}, refer=entry;\n'
+              .format(i, length))
+        extra = ''.join(', p{0}{1}'.format(n, arg_values[n % len(arg_values)])
+                        for n in range(args)).format(i)
+        for j in range(elements):
+            write('e{0}x{1}: {2}, at={3:.4f}{4};\n'
+                  .format(i, j, types[j % len(types)], positions[j], extra))
+        write('endsequence;\n')
+
+
+class Sink(object):
+
+    """Output stream that only counts the size of the written data."""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+    def flush(self):
+        pass
+
+
+def measure(func, repeat=1, memory=True):
+    """
+    Run a stage and measure its time and peak memory usage.
+
+    :param func: callable without arguments
+    :param int repeat: number of timed runs
+    :param bool memory: measure the peak memory in an additional run
+    :returns: result of the last call and the measurements
+    :rtype: tuple
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    info = {'time': best}
+    if memory:
+        import gc
+        import tracemalloc
+        del result
+        gc.collect()
+        tracemalloc.start()
+        try:
+            result = func()
+            info['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, info
+
+
+def run(lines, rules, count, formats=formats, repeat=1, memory=True):
+    """
+    Run the stages on the input lines and collect the measurements.
+
+    The ``parse_lines`` stage parses the statements of all lines (as
+    :meth:`madseq.Document.parse_line` does for a single line), ``detect``
+    groups them into sequences, ``transform`` applies the slicing rules and
+    the ``dump_<fmt>`` stages serialize the transformed document.
+
+    :param list lines: MAD-X input lines
+    :param list rules: slicing rules
+    :param int count: number of input elements, for the throughput
+    :param formats: dump formats
+    :param int repeat: number of timed runs for each stage
+    :param bool memory: measure the peak memory usage
+    :returns: measurements by stage name
+    :rtype: dict
+    """
+    results = {}
+
+    def stage(name, func):
+        result, info = measure(func, repeat, memory)
+        if info['time']:
+            info['elements_per_second'] = count / info['time']
+        results[name] = info
+        return result
+
+    Document = madseq.Document
+    nodes = stage('parse_lines', lambda: list(Document.parse_lines(lines)))
+    nodes = stage('detect', lambda: list(madseq.Sequence.detect(nodes)))
+    document = stage('transform', lambda: Document(nodes).transform(
+        madseq.SequenceTransform(rules)))
+    for fmt in formats:
+        def dump():
+            sink = Sink()
+            document.dump(sink, fmt)
+            return sink.size
+        try:
+            size = stage('dump_' + fmt, dump)
+        except ImportError as e:
+            results['dump_' + fmt] = {'error': str(e)}
+        else:
+            results['dump_' + fmt]['size'] = size
+    return results
+
+
+def main(argv=None):
+
+    from docopt import docopt
+    args = docopt(__doc__, argv, version=__version__)
+
+    options = dict(sequences=int(args['--sequences']),
+                   elements=int(args['--elements']),
+                   depth=int(args['--depth']),
+                   args=int(args['--args']))
+    rules = slicing(args['--rules'])
+
+    if args['generate']:
+        if args['<output>'] and args['<output>'] != '-':
+            with open(args['<output>'], 'wt') as f:
+                generate(f, **options)
+        else:
+            generate(sys.stdout, **options)
+        json.dump(rules, sys.stderr)
+        sys.stderr.write('\n')
+        return
+
+    text = io.StringIO()
+    generate(text, **options)
+    text = text.getvalue()
+    lines = text.splitlines(True)
+    count = options['sequences'] * options['elements']
+    fmts = [fmt for fmt in args['--formats'].split(',') if fmt]
+
+    report = {
+        'madseq': madseq.__version__,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'lattice': dict(options, rules=args['--rules'],
+                        lines=len(lines), size=len(text)),
+        'stages': run(lines, rules, count, fmts,
+                      int(args['--repeat']), not args['--no-memory']),
+    }
+    del text, lines
+    try:
+        import resource
+        report['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:     # windows
+        pass
+
+    if args['--output']:
+        with open(args['--output'], 'wt') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+main.__doc__ = __doc__
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#! /usr/bin/env python
+"""
+drift - compare slice positions of the number types against decimal.
+
+Usage:
+    drift.py [options]
+    drift.py (--help | --version)
+
+Options:
+    -n <num>, --sequences=<num>     Number of sequences [default: 1]
+    -m <num>, --elements=<num>      Number of elements per sequence
+                                    [default: 20000]
+    -s <num>, --slice=<num>         Number of slices per element
+                                    [default: 3]
+    -t <types>, --types=<types>     Comma separated number types to compare
+                                    [default: float,fixed,numpy]
+    -o <file>, --output=<file>      Write the report to this file
+    -h, --help                      Show this help
+    -v, --version                   Show version information
+
+Generates a lattice (see bench.py), slices all elements with every number
+type and prints a JSON report with the deviation of the written AT and L
+values from the ``decimal`` result: the maximum and mean absolute deviation
+and the number of values that are written differently. The lattice is
+generated deterministically, so the report is reproducible.
+"""
+
+import io
+import json
+import os
+import platform
+import sys
+from decimal import Decimal
+
+# compare the madseq module of this checkout:
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import madseq
+from bench import base_types, generate
+
+
+__version__ = 'drift 0.1'
+
+
+def written_values(document):
+    """
+    Get the AT and L values of the sequence elements as written.
+
+    :param madseq.Document document: transformed document
+    :returns: ``(at, L)`` text pairs, ``None`` for missing values
+    :rtype: list
+    """
+    def text(elem, key):
+        value = elem.get(key)
+        return None if value is None else madseq.format_value(value)
+    return [(text(elem, 'at'), text(elem, 'L'))
+            for node in document._nodes
+            if isinstance(node, madseq.Sequence)
+            for elem in node.iter_body()
+            if elem.type]
+
+
+def deviation(values, reference):
+    """
+    Compare written values with the reference values.
+
+    :param list values: texts of the values
+    :param list reference: texts of the reference values
+    :returns: maximum and mean absolute deviation, number of differences
+    :rtype: dict
+    """
+    diffs = [abs(Decimal(value) - Decimal(ref))
+             for value, ref in zip(values, reference)
+             if value is not None and ref is not None]
+    return {
+        'max': float(max(diffs)) if diffs else 0.0,
+        'mean': float(sum(diffs) / len(diffs)) if diffs else 0.0,
+        'differences': sum(value != ref
+                           for value, ref in zip(values, reference)),
+    }
+
+
+def compare(lines, slice_num, types):
+    """
+    Slice the lattice with each number type and compare with ``decimal``.
+
+    :param list lines: MAD-X input lines
+    :param int slice_num: number of slices per element
+    :param list types: names of the number types, see madseq.number_types
+    :returns: deviations of AT and L by number type
+    :rtype: dict
+    """
+    document = madseq.Document.parse(lines)
+    rules = [{'type': base, 'slice': slice_num}
+             for base, _, length in base_types if length]
+
+    def transform(arithmetic):
+        node_transform = madseq.SequenceTransform(rules, arithmetic=arithmetic)
+        return written_values(document.transform(node_transform))
+
+    reference = transform('decimal')
+    results = {}
+    for name in types:
+        values = transform(name)
+        if len(values) != len(reference):
+            raise RuntimeError("Number of elements differs for {0!r}"
+                               .format(name))
+        results[name] = {
+            'at': deviation([at for at, _ in values],
+                            [at for at, _ in reference]),
+            'L': deviation([l for _, l in values],
+                           [l for _, l in reference]),
+        }
+    return results
+
+
+def main(argv=None):
+
+    from docopt import docopt
+    args = docopt(__doc__, argv, version=__version__)
+
+    options = dict(sequences=int(args['--sequences']),
+                   elements=int(args['--elements']))
+    slice_num = int(args['--slice'])
+    types = [name for name in args['--types'].split(',') if name]
+
+    text = io.StringIO()
+    generate(text, depth=1, args=0, **options)
+    lines = text.getvalue().splitlines(True)
+
+    report = {
+        'madseq': madseq.__version__,
+        'python': platform.python_version(),
+        'lattice': dict(options, slice=slice_num, lines=len(lines)),
+        'deviation': compare(lines, slice_num, types),
+    }
+
+    if args['--output']:
+        with open(args['--output'], 'wt') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+main.__doc__ = __doc__
+
+
+if __name__ == '__main__':
+    main()
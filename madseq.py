@@ -3,13 +3,46 @@
 madseq - MAD-X sequence parser/transformer.
 
 Usage:
-    madseq.py [-j|-y] [-s <slice>] [<input>] [<output>]
+    madseq.py [(-j | -y) [--style=<style>] | -b] [-s <slice>]
+              [--stream | -p <jobs>]
+              [-n <type>] [-c] [--cache=<dir> [--cache-size=<mb>]] [-i] [-m]
+              [--select=<names>] [<input>] [<output>]
     madseq.py (--help | --version)
 
 Options:
     -j, --json                      Use JSON as output format
     -y, --yaml                      Use YAML as output format
+    --style=<style>                 Layout of JSON output: pretty (default),
+                                    compact or ndjson (one line per
+                                    element); of YAML output: mapping
+                                    (default) or documents (one document
+                                    per sequence)
+    -b, --binary                    Use binary output format
     -s <slice>, --slice=<slice>     Set slicing definition file
+    --stream                        Process the input node by node instead
+                                    of loading the whole document
+    -p <jobs>, --jobs=<jobs>        Transform sequences in parallel using
+                                    the given number of processes, 0 to use
+                                    all processors (not with --incremental)
+                                    [default: 1]
+    -n <type>, --numeric=<type>     Number type for positions: decimal,
+                                    float, fixed or numpy [default: decimal]
+    -c, --columnar                  Store sequences in columns to reduce
+                                    memory usage
+    --cache=<dir>                   Cache parsed input files in the directory
+                                    (not used with --stream)
+    --cache-size=<mb>               Maximum size of the cache directory in
+                                    megabytes [default: 1024]
+    -i, --incremental               Only transform sequences whose inputs
+                                    changed since the last run and reuse the
+                                    stored output of the others (MAD-X
+                                    <output> file only)
+    -m, --mmap                      Read the input file through a memory
+                                    map (not used with --cache)
+    --select=<names>                Only parse and transform the sequences
+                                    matching one of the comma separated
+                                    glob patterns, e.g. "lhcb*,ring", and
+                                    copy the others unchanged
     -h, --help                      Show this help
     -v, --version                   Show version information
 
@@ -22,9 +55,13 @@ the file and update the AT=.. values of all elements.
 from __future__ import division
 
 # standard library
-from itertools import chain
+from itertools import chain, islice
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping, MutableMapping
 from functools import partial
 import re
+import sys
 from math import ceil
 from decimal import Decimal, InvalidOperation
 
@@ -53,16 +90,121 @@ def none_checked(type):
     def constructor(value):
         return None if value is None else type(value)
     constructor.cls = type
+    # let pickle find the constructor under the name of the class:
+    constructor.__name__ = type.__name__
+    constructor.__module__ = type.__module__
+    constructor.__doc__ = type.__doc__
+    if hasattr(type, '__qualname__'):
+        constructor.__qualname__ = type.__qualname__
     return constructor
 
 
+# lowercase forms of the interned stri instances by id(), see stri:
+_stri_folded = {}
+
+
 @none_checked
 class stri(str):
-    """Case insensitive string."""
+
+    """
+    Case insensitive string.
+
+    :cvar OrderedDict _interned: instances by value, least recently used
+                                 first
+    :cvar int _intern_size: maximum number of interned instances
+
+    Instances are interned, so that repeated names such as element types
+    share one object and usually compare by identity. When the table is
+    full the least recently used instance is dropped from it. The interned
+    lowercase form of each interned instance is kept in ``_stri_folded``
+    instead of an attribute, so an instance is no larger than a str.
+    Instances that were dropped from the table compute it when needed.
+    """
+
+    __slots__ = ()
+
+    _interned = OrderedDict()
+    _intern_size = 65536
+
+    def __new__(cls, value):
+        if value.__class__ is not str:
+            if value.__class__ is cls:
+                return value
+            value = str(value)
+        interned = cls._interned
+        self = interned.get(value)
+        if self is not None:
+            interned.move_to_end(value)
+            return self
+        self = str.__new__(cls, value)
+        if len(interned) >= cls._intern_size:
+            del _stri_folded[id(interned.popitem(last=False)[1])]
+        interned[value] = self
+        _stri_folded[id(self)] = sys.intern(value.lower())
+        return self
+
     def __eq__(self, other):
-        return self.lower() == str(other).lower()
+        if self is other:
+            return True
+        if other.__class__ is self.__class__:
+            other = _stri_folded.get(id(other)) or other.lower()
+        elif isinstance(other, str):
+            other = other.lower()
+        else:
+            other = str(other).lower()
+        return (_stri_folded.get(id(self)) or self.lower()) == other
+
     def __ne__(self, other):
-        return not (self == other)
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(_stri_folded.get(id(self)) or self.lower())
+
+    def __reduce__(self):
+        return (stri, (str(self),))
+
+
+class LRUCache(object):
+
+    """
+    Bounded cache that discards the least recently used entries.
+
+    :ivar int maxsize: maximum number of entries
+    :ivar int hits: number of lookups that found an entry
+    :ivar int misses: number of lookups that had to compute the value
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, compute):
+        """Get the value for the key, call ``compute()`` if missing."""
+        data = self._data
+        try:
+            value = data[key]
+        except KeyError:
+            self.misses += 1
+            value = compute()
+            if self.maxsize > 0:
+                data[key] = value
+                if len(data) > self.maxsize:
+                    data.popitem(last=False)
+            return value
+        self.hits += 1
+        data.move_to_end(key)
+        return value
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
 
 
 class Re(object):
@@ -120,6 +262,9 @@ class regex(object):
     # MAD-X command: name: type, *args;
     cmd = Re(r'^\s*(?:(',identifier,r')\s*:)?\s*(',identifier,r')\s*(,.*)?;\s*$')
 
+    # MAD-X statement without the terminating semicolon: name: type, *args
+    statement = Re(r'^\s*(?:(',identifier,r')\s*:)?\s*(',identifier,r')\s*(,.*)?$')
+
     #----------------------------------------
     # grouping expressions
     #----------------------------------------
@@ -128,6 +273,37 @@ class regex(object):
     # (argument, assignment, value)
     arg = Re(r',\s*(',identifier,r')\s*(:?=)\s*(',param,')\s*')
 
+    # same as `arg`, but classify the value while matching the same text.
+    # The lookaheads make sure that a numeric or identifier value spans the
+    # full extent of `thingy`. The kind of value is the name of the last
+    # matched group:
+    arg_token = Re(r',\s*(',identifier,r')\s*(:?=)\s*(?:',
+                   r'"(?P<string>[^"]*)"', '|',
+                   r'(?P<array>',array,')', '|',
+                   r'(?P<int>[+\-]?\d+)(?![^\s,;!])', '|',
+                   r'(?P<float>',number,r')(?![^\s,;!])', '|',
+                   r'(?P<identifier>',identifier,r')(?![^\s,;!])', '|',
+                   r'(?P<thingy>',thingy,')',
+                   r')\s*')
+
+    # classify a single parameter value with the same group names as
+    # `arg_token`. Values not matched by this are neither numbers, strings
+    # nor identifiers:
+    value_token = Re(r'^\s*(?:',
+                     r'"(?P<string>[^"]*)"', '|',
+                     r'(?P<int>[+\-]?\d+)', '|',
+                     r'(?P<float>',number,')', '|',
+                     r'(?P<identifier>',identifier,')',
+                     r')\s*$')
+
+    # quoted string (possibly unterminated), comment start or statement
+    # separator. Used to find the syntactically relevant characters in
+    # lines that contain quotes:
+    code_token = Re(r'"[^"]*"?|!|//|;')
+
+    # characters that may be accepted by int() or Decimal()
+    numeric_chars = Re(r'^[\w.+\-]*$')
+
     # match TEXT!COMMENT and return both parts as groups
     comment_split = Re(r'^([^!]*)(!.*)?$')
 
@@ -137,6 +313,21 @@ class regex(object):
     # match+group an identifier
     is_identifier = Re(r'^\s*(',identifier,')\s*$')
 
+    # match a sequence header statement and group its name:
+    sequence_head = Re(r'(?i)^\s*(',identifier,r')\s*:\s*sequence\s*(?:,|$)')
+
+    # match an ENDSEQUENCE statement without the terminating semicolon:
+    sequence_end = Re(r'(?i)^\s*endsequence\s*$')
+
+    # find lines that may contain an ENDSEQUENCE statement:
+    has_sequence_end = Re(r'(?i)endsequence')
+
+    # number without leading zeros at the end of a name, below 10**9:
+    trailing_number = Re(r'(?:0|[1-9][0-9]{0,8})$')
+
+    # slice index at the end of a name, e.g. ``q1..3``:
+    slice_index = Re(r'\.\.(0|[1-9][0-9]{0,8})$')
+
 
 #----------------------------------------
 # Line model + parsing + formatting
@@ -161,7 +352,11 @@ def format_value(value):
             return str(value.normalize())
         elif isinstance(value, str):
             return '"' + value + '"'
-        elif isinstance(value, (float, int)):
+        elif isinstance(value, float):
+            # shortest form that reads back as the same float, also for
+            # subclasses like numpy.float64:
+            return float.__repr__(value)
+        elif isinstance(value, int):
             return str(value)
         elif isinstance(value, (tuple, list)):
             return '{' + ','.join(map(format_value, value)) + '}'
@@ -222,6 +417,19 @@ class Value(object):
     @classmethod
     def parse(cls, text, assign='='):
         """Parse MAD-X parameter input as any of the known Value types."""
+        match = regex.value_token.r.match(text)
+        if match:
+            kind = match.lastgroup
+            return _token_parsers[kind](match.group(kind), assign)
+        # anything that is neither array nor number can only be composed:
+        stripped = text.strip()
+        if stripped[:1] != '{' and not regex.numeric_chars.r.match(stripped):
+            return Composed(text, assign)
+        return cls._parse_any(text, assign)
+
+    @classmethod
+    def _parse_any(cls, text, assign='='):
+        """Try to parse the text as each of the known Value types in turn."""
         try:
             return parse_number(text)
         except ValueError:
@@ -352,9 +560,112 @@ class Composed(Symbolic):
 
 def parse_args(text):
     """Parse argument list into ordered dictionary."""
-    # TODO: use .split(',') to make expression simpler
-    return odicti((key, Value.parse(val, assign))
-                  for key,assign,val in regex.arg.findall(text or ''))
+    return ArgDict(tokenize_args(text))
+
+
+def tokenize_args(text):
+    """
+    Parse argument list in a single scan.
+
+    Yields the same ``(key, value)`` pairs as matching ``regex.arg`` and
+    passing the values through :meth:`Value.parse`, but determines the value
+    type while matching and therefore avoids retrying the individual parsers.
+
+    :param str text: argument list including leading comma
+    :returns: key, value pairs
+    :rtype: list
+    """
+    if not text:
+        return []
+    args = []
+    append = args.append
+    for match in regex.arg_token.r.finditer(text):
+        (key, assign,
+         string, array, integer, number, identifier, thingy) = match.groups()
+        if integer is not None:
+            value = int(integer)
+        elif number is not None:
+            value = Decimal(number)
+        elif identifier is not None:
+            value = _parse_identifier_token(identifier, assign)
+        elif string is not None:
+            value = string
+        elif array is not None:
+            value = Array.parse(array, assign)
+        else:
+            value = Value.parse(thingy, assign)
+        append((key, value))
+    return args
+
+
+def _parse_identifier_token(text, assign):
+    """Parse a token that looks like an identifier."""
+    # Decimal accepts special values such as 'inf' or 'NaN', which are
+    # therefore parsed as numbers by Value.parse:
+    if text[:3].lower() in ('inf', 'nan', 'sna'):
+        return Value._parse_any(text, assign)
+    return Identifier(text, assign)
+
+
+# value constructors for the named groups in `regex.value_token`:
+_token_parsers = {
+    'string': lambda text, assign: text,
+    'int': lambda text, assign: int(text),
+    'float': lambda text, assign: Decimal(text),
+    'identifier': _parse_identifier_token,
+}
+
+
+def split_comment(line):
+    """
+    Split a line into code and comment.
+
+    Comments start with ``!`` or ``//`` outside of quoted strings.
+
+    :param str line: input line
+    :returns: code, comment (``None`` if there is no comment)
+    :rtype: tuple
+    """
+    if '"' in line:
+        for match in regex.code_token.r.finditer(line):
+            if match.group() in ('!', '//'):
+                split = match.start()
+                break
+        else:
+            return line, None
+    else:
+        split = line.find('!')
+        slash = line.find('//')
+        if slash != -1 and (split == -1 or slash < split):
+            split = slash
+        if split == -1:
+            return line, None
+    return line[:split], line[split:].rstrip('\n')
+
+
+def split_statements(code):
+    """Split code at semicolons that are not inside quoted strings."""
+    if '"' not in code:
+        return code.split(';')
+    parts = []
+    start = 0
+    for match in regex.code_token.r.finditer(code):
+        if match.group() == ';':
+            parts.append(code[start:match.start()])
+            start = match.end()
+    parts.append(code[start:])
+    return parts
+
+
+def is_block_delimiter(text):
+    """Check if unterminated code opens or closes a ``{...}`` block."""
+    text = text.strip()
+    if text.startswith('}'):
+        return True
+    if text.endswith('{'):
+        # exclude the start of a multi-line array such as KNL={...}:
+        return text[:-1].rstrip()[-1:] not in ('=', ',')
+    return False
 
 
 class Element(object):
@@ -364,7 +675,8 @@ class Element(object):
 
     :ivar str name: element name or ``None``
     :ivar str type: element type name
-    :ivar odicti args: element arguments
+    :ivar args: element arguments, usually :class:`ArgDict` or
+                :class:`OverlayArgs`
     :ivar _base: base element, if available
 
     :class:`Element` a :class:`dict`-like interface to access arguments.
@@ -394,6 +706,19 @@ class Element(object):
         name, type, args = regex.cmd.match(text).groups()
         return Element(name, type, parse_args(args))
 
+    @classmethod
+    def parse_statement(cls, text):
+        """
+        Parse element from a MAD-X statement without trailing semicolon.
+
+        :returns: the element or ``None`` if the statement is not an element
+        """
+        match = regex.statement.r.match(text)
+        if match is None:
+            return None
+        name, type, args = match.groups()
+        return Element(name, type, parse_args(args))
+
     def __str__(self):
         """Format element in MAD-X format."""
         return ''.join((
@@ -421,7 +746,7 @@ class Element(object):
         if self._base:
             args = self._base.all_args
         else:
-            args = odicti()
+            args = ArgDict()
         args.update(self.args)
         return args
 
@@ -429,8 +754,15 @@ class Element(object):
 
     def copy(self):
         """Create a copy of this element that can be safely modified."""
-        return self.__class__(self.name, self.type, self.args.copy(),
-                              self._base)
+        # The copy stores only its own changes on top of shared arguments:
+        args = self.args
+        if args.__class__ is OverlayArgs:
+            args = args.copy()
+        elif args.__class__ is ArgDict:
+            args = OverlayArgs._from_base(args._share())
+        else:
+            args = OverlayArgs(args)
+        return self.__class__(self.name, self.type, args, self._base)
 
     def __contains__(self, key):
         """Check whether key exists as argument in self or base."""
@@ -479,6 +811,365 @@ class Element(object):
                 self.args == other.args)
 
 
+class ArgDict(MutableMapping):
+
+    """
+    Ordered case insensitive mapping for the few arguments of an element.
+
+    :ivar list _lower: lowercase keys
+    :ivar list _keys: keys in their original case
+    :ivar list _values: values
+    :ivar tuple _shared: the three lists while they are shared with copies
+                         or :class:`OverlayArgs`, otherwise ``None``
+
+    Keys are normalized once when they are inserted. Lookups scan the list
+    of lowercase keys, which is faster than hashing for the small number of
+    arguments of MAD-X elements. Setting an existing key updates its case.
+    Copies share the lists until one of them is modified (copy on write).
+    """
+
+    __slots__ = ['_lower', '_keys', '_values', '_shared']
+
+    def __init__(self, items=()):
+        """Initialize from a mapping or an iterable of pairs."""
+        self._lower = []
+        self._keys = []
+        self._values = []
+        self._shared = None
+        # skip the slow ABC check for the lists of parse_args:
+        if items.__class__ is not list and isinstance(items, Mapping):
+            items = items.items()
+        lowers, keys, values = self._lower, self._keys, self._values
+        for key, value in items:
+            lower = key.lower()
+            if lower in lowers:
+                index = lowers.index(lower)
+                keys[index] = key
+                values[index] = value
+            else:
+                lowers.append(lower)
+                keys.append(key)
+                values.append(value)
+
+    @classmethod
+    def _from_lists(cls, lower, keys, values):
+        """Create from lists of unique lowercase keys, keys and values."""
+        args = cls.__new__(cls)
+        args._lower = lower
+        args._keys = keys
+        args._values = values
+        args._shared = None
+        return args
+
+    def copy(self):
+        """Create a shallow copy that shares the lists until modified."""
+        shared = self._share()
+        args = self._from_lists(*shared)
+        args._shared = shared
+        return args
+
+    def _share(self):
+        """Get the lists as a tuple that will not be modified anymore."""
+        if self._shared is None:
+            self._shared = (self._lower, self._keys, self._values)
+        return self._shared
+
+    def _unshare(self):
+        """Copy the lists before the first modification if they are shared."""
+        self._lower = self._lower[:]
+        self._keys = self._keys[:]
+        self._values = self._values[:]
+        self._shared = None
+
+    def _index(self, lower):
+        """Get the index of a lowercase key or -1."""
+        if lower in self._lower:
+            return self._lower.index(lower)
+        return -1
+
+    def __getitem__(self, key):
+        lower = key.lower()
+        if lower in self._lower:
+            return self._values[self._lower.index(lower)]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        lower = key.lower()
+        if lower in self._lower:
+            return self._values[self._lower.index(lower)]
+        return default
+
+    def __setitem__(self, key, value):
+        if self._shared is not None:
+            self._unshare()
+        lower = key.lower()
+        index = self._index(lower)
+        if index < 0:
+            self._lower.append(lower)
+            self._keys.append(key)
+            self._values.append(value)
+        else:
+            self._keys[index] = key
+            self._values[index] = value
+
+    def __delitem__(self, key):
+        index = self._index(key.lower())
+        if index < 0:
+            raise KeyError(key)
+        if self._shared is not None:
+            self._unshare()
+        del self._lower[index]
+        del self._keys[index]
+        del self._values[index]
+
+    def __contains__(self, key):
+        return key.lower() in self._lower
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def items(self):
+        """Get the list of ``(key, value)`` pairs."""
+        return list(zip(self._keys, self._values))
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return _folded(self) == _folded(other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(self.__class__.__name__, self.items())
+
+
+def _folded(mapping):
+    """Get a dict with lowercase keys for comparisons."""
+    return dict((key.lower(), value) for key, value in mapping.items())
+
+
+class OverlayArgs(MutableMapping):
+
+    """
+    Copy-on-write element arguments on top of a shared mapping.
+
+    :ivar tuple _base: shared lowercase keys, keys and values (see
+                       :meth:`ArgDict._share`), never modified
+    :ivar list _changed: ``(lower, key, value)`` tuples of the arguments
+                         set since the last copy, in order of insertion
+    :ivar set _deleted: lowercase names of deleted arguments of the base
+
+    Copies share the same base and store only the arguments that are set
+    or deleted afterwards, which are usually few, e.g. the AT value of an
+    element slice. Iteration yields the arguments of the base in their
+    original order, followed by new arguments. A changed argument keeps its
+    position, but is listed with the case of the name it was set with.
+    """
+
+    __slots__ = ['_base', '_changed', '_deleted']
+
+    def __init__(self, base=()):
+        """
+        Share the arguments of the base mapping.
+
+        An :class:`ArgDict` copies its arguments before it is modified
+        again, other mappings are copied right away.
+        """
+        if not isinstance(base, ArgDict):
+            base = ArgDict(base)
+        self._base = base._share()
+        self._changed = []
+        self._deleted = None
+
+    @classmethod
+    def _from_base(cls, base):
+        """Create from the tuple of shared lists."""
+        args = cls.__new__(cls)
+        args._base = base
+        args._changed = []
+        args._deleted = None
+        return args
+
+    def copy(self):
+        """Create a copy that shares the current arguments."""
+        if self._changed or self._deleted:
+            # store the current state as new base, so that further copies
+            # are cheap:
+            self._base = ArgDict(self.items())._share()
+            self._changed = []
+            self._deleted = None
+        return self._from_base(self._base)
+
+    def _find(self, lower):
+        """Get the index of a changed argument or -1."""
+        for index, item in enumerate(self._changed):
+            if item[0] == lower:
+                return index
+        return -1
+
+    def _in_base(self, lower):
+        """Check if the argument is in the base and was not deleted."""
+        return (lower in self._base[0] and
+                not (self._deleted and lower in self._deleted))
+
+    def __getitem__(self, key):
+        lower = key.lower()
+        for item in self._changed:
+            if item[0] == lower:
+                return item[2]
+        lowers, _, values = self._base
+        if lower not in lowers or self._deleted and lower in self._deleted:
+            raise KeyError(key)
+        return values[lowers.index(lower)]
+
+    def __setitem__(self, key, value):
+        lower = key.lower()
+        index = self._find(lower)
+        if index < 0:
+            self._changed.append((lower, key, value))
+        else:
+            self._changed[index] = (lower, key, value)
+
+    def __delitem__(self, key):
+        lower = key.lower()
+        index = self._find(lower)
+        in_base = self._in_base(lower)
+        if index < 0 and not in_base:
+            raise KeyError(key)
+        if index >= 0:
+            del self._changed[index]
+        if in_base:
+            if self._deleted is None:
+                self._deleted = set()
+            self._deleted.add(lower)
+
+    def __contains__(self, key):
+        lower = key.lower()
+        return self._find(lower) >= 0 or self._in_base(lower)
+
+    def __iter__(self):
+        return (key for key, value in self.items())
+
+    def items(self):
+        """Get the list of ``(key, value)`` pairs."""
+        if self._deleted:
+            return list(self._iter_items())
+        # usual case, e.g. slices that only set their AT value:
+        lowers, keys, values = self._base
+        items = list(zip(keys, values))
+        for lower, key, value in self._changed:
+            if lower in lowers:
+                items[lowers.index(lower)] = (key, value)
+            else:
+                items.append((key, value))
+        return items
+
+    def _iter_items(self):
+        """Iterate over ``(key, value)`` pairs, taking deletions into account."""
+        lowers, keys, values = self._base
+        changed = dict((item[0], item) for item in self._changed)
+        deleted = self._deleted or ()
+        for lower, key, value in zip(lowers, keys, values):
+            if lower in deleted:
+                continue
+            item = changed.pop(lower, None)
+            if item is None:
+                yield key, value
+            else:
+                yield item[1], item[2]
+        for item in self._changed:
+            if item[0] in changed:
+                yield item[1], item[2]
+
+    def __len__(self):
+        return len(self.items())
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return _folded(self) == _folded(other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(self.__class__.__name__, self.items())
+
+
+class Definitions(dict):
+
+    """
+    Element lookup table that caches the resolved base definitions.
+
+    :ivar dict _resolved: flattened definitions by lowercase name
+
+    Names are looked up case insensitively and stored in lowercase.
+
+    The flattened form of a definition is an :class:`Element` without base
+    that has the root type and the merged arguments of the definition and
+    all its bases. Using it as the ``_base`` of other elements makes type
+    and argument lookups independent of the depth of the inheritance chain.
+    A cached entry is dropped when its name is redefined. Definitions are
+    assumed not to be modified in place after they have been resolved.
+    """
+
+    def __init__(self, items=()):
+        """Initialize from an iterable of ``(name, element)`` pairs."""
+        super(Definitions, self).__init__()
+        self._resolved = {}
+        for name, elem in items:
+            self[name] = elem
+
+    def __reduce__(self):
+        return (self.__class__, (list(self.items()),))
+
+    def __getitem__(self, name):
+        return dict.__getitem__(self, str(name).lower())
+
+    def __setitem__(self, name, elem):
+        key = str(name).lower()
+        dict.__setitem__(self, key, elem)
+        self._resolved.pop(key, None)
+
+    def __delitem__(self, name):
+        key = str(name).lower()
+        dict.__delitem__(self, key)
+        self._resolved.pop(key, None)
+
+    def __contains__(self, name):
+        return dict.__contains__(self, str(name).lower())
+
+    def get(self, name, default=None):
+        return dict.get(self, str(name).lower(), default)
+
+    def resolve(self, name):
+        """Get the flattened definition for the name or ``None``."""
+        key = str(name).lower()
+        try:
+            return self._resolved[key]
+        except KeyError:
+            pass
+        elem = dict.get(self, key)
+        if elem is not None:
+            elem = Element(elem.name, elem.base_type, elem.all_args)
+        self._resolved[key] = elem
+        return elem
+
+
+def resolve(defs, name):
+    """Get base element from a :class:`Definitions` or plain lookup table."""
+    try:
+        return defs.resolve(name)
+    except AttributeError:
+        return defs.get(name)
+
+
 class Text(str):
 
     """A text section in a MAD-X document."""
@@ -518,7 +1209,15 @@ class Sequence(object):
 
     def __str__(self):
         """Format sequence to MAD-X format."""
-        return '\n'.join(map(str, self._preface + self._elements))
+        return '\n'.join(map(str, self.iter_nodes()))
+
+    def iter_nodes(self):
+        """Iterate over preface and elements in output order."""
+        return chain(self._preface, self._elements)
+
+    def iter_body(self):
+        """Iterate over the sequence body without building a list."""
+        return islice(self._elements, 1, len(self._elements) - 1)
 
     @classmethod
     def detect(cls, elements):
@@ -543,29 +1242,618 @@ class Sequence(object):
                 yield elem
 
 
+class LazySequence(Sequence):
+
+    """
+    MAD-X sequence whose body is generated on demand.
+
+    :ivar function _generate: returns a new iterable over the body
+    """
+
+    def __init__(self, head, generate, tail, preface=None):
+        self._preface = preface or []
+        self._head = head
+        self._generate = generate
+        self._tail = tail
+
+    @property
+    def head(self):
+        """Get sequence head element (the one with type SEQUENCE)."""
+        return self._head
+
+    @property
+    def body(self):
+        """Get sequence body (all elements inside)."""
+        return list(self._generate())
+
+    @property
+    def tail(self):
+        """Get sequence tail element (the one with type ENDSEQUENCE)."""
+        return self._tail
+
+    def iter_nodes(self):
+        """Iterate over preface and elements in output order."""
+        return chain(self._preface, [self._head], self._generate(),
+                     [self._tail])
+
+    def iter_body(self):
+        """Iterate over the sequence body without building a list."""
+        return iter(self._generate())
+
+
+class ColumnarSequence(Sequence):
+
+    """
+    MAD-X sequence that stores its body in columns instead of objects.
+
+    :ivar list _strings: string table of names and types, ``None`` at 0
+    :ivar dict _string_ids: string table index by string
+    :ivar list _shapes: tuples of argument names in their original order
+    :ivar dict _shape_ids: shape index by tuple of argument names
+    :ivar list _roles: for each shape, whether each argument is AT, L or
+                       another argument (see :attr:`AT`, :attr:`L`)
+    :ivar array _names: string id of each body node's name without its
+                        trailing number and slice index
+    :ivar array _numbers: trailing number of each name, ``-1`` if none
+    :ivar array _slice_index: slice index of each name, ``-1`` if none
+    :ivar array _types: type string id of each body node, 0 for Text
+    :ivar array _shape_of: shape id of each body node
+    :ivar NumberColumn _at: AT value of each body node
+    :ivar NumberColumn _length: L value of each body node
+    :ivar array _arg_offsets: start of each node's values in _arg_values
+    :ivar NumberColumn _arg_values: values of the remaining arguments
+
+    Every body node costs a few machine integers plus its argument values,
+    which are stored in a :class:`NumberColumn`. Names that end with a
+    number and slice index, like ``q12`` or the slice name ``q12..3``, are
+    stored as the string id of the prefix and the numbers, so the prefix
+    is shared by many names. Text nodes are
+    stored with their text as name. Elements are created on the fly when
+    iterating the body, so changes to them are not stored back. MAD-X
+    output is formatted directly from the columns (see :meth:`iter_lines`).
+    """
+
+    OTHER, AT, L = range(3)
+
+    def __init__(self, head, body, tail, preface=None):
+        """
+        Store the head and tail elements and the columns of the body.
+
+        :param Element head: the SEQUENCE element
+        :param body: iterable of Text/Element nodes
+        :param Element tail: the ENDSEQUENCE element
+        :param list preface: nodes to output before the sequence
+        """
+        self._preface = [] if preface is None else preface
+        self._head = head
+        self._tail = tail
+        self._strings = [None]
+        self._string_ids = {None: 0}
+        self._shapes = []
+        self._shape_ids = {}
+        self._roles = []
+        self._names = array('i')
+        self._numbers = array('i')
+        self._slice_index = array('i')
+        self._types = array('i')
+        self._shape_of = array('i')
+        self._at = NumberColumn()
+        self._length = NumberColumn()
+        self._arg_offsets = array('l', [0])
+        self._arg_values = NumberColumn()
+        self.extend(body)
+
+    @classmethod
+    def from_sequence(cls, seq):
+        """Create from any other :class:`Sequence`."""
+        return cls(seq.head, seq.iter_body(), seq.tail, list(seq._preface))
+
+    def to_sequence(self):
+        """Convert to a :class:`Sequence` of :class:`Element` objects."""
+        return Sequence([self._head] + self.body + [self._tail],
+                        list(self._preface))
+
+    @property
+    def head(self):
+        """Get sequence head element (the one with type SEQUENCE)."""
+        return self._head
+
+    @property
+    def body(self):
+        """Get sequence body (all elements inside)."""
+        return list(self.iter_body())
+
+    @property
+    def tail(self):
+        """Get sequence tail element (the one with type ENDSEQUENCE)."""
+        return self._tail
+
+    def __len__(self):
+        """Get the number of body nodes."""
+        return len(self._types)
+
+    def iter_nodes(self):
+        """Iterate over preface and elements in output order."""
+        return chain(self._preface, [self._head], self.iter_body(),
+                     [self._tail])
+
+    def iter_body(self):
+        """Create the body nodes one by one."""
+        return (self._node(row) for row in range(len(self._types)))
+
+    def iter_lines(self):
+        """Iterate over the MAD-X lines in output order."""
+        return chain(map(str, self._preface), [str(self._head)],
+                     map(self._format, range(len(self._types))),
+                     [str(self._tail)])
+
+    def append(self, node):
+        """Append a Text or Element node to the body."""
+        if node.type:
+            name, type, items = node.name, node.type, node.args.items()
+        else:
+            name, type, items = node, None, ()
+        name, number, slice_idx = self._split_name(name)
+        self._names.append(name)
+        self._numbers.append(number)
+        self._slice_index.append(slice_idx)
+        self._types.append(self._intern(type))
+        keys = tuple([key for key, value in items])
+        try:
+            shape = self._shape_ids[keys]
+        except KeyError:
+            shape = self._add_shape(keys)
+        self._shape_of.append(shape)
+        at = length = None
+        values = self._arg_values
+        for role, (key, value) in zip(self._roles[shape], items):
+            if role == self.AT:
+                at = value
+            elif role == self.L:
+                length = value
+            else:
+                values.append(value)
+        self._at.append(at)
+        self._length.append(length)
+        self._arg_offsets.append(len(values))
+
+    def extend(self, nodes):
+        """Append Text or Element nodes or :class:`Slices` to the body."""
+        if isinstance(nodes, Slices):
+            self._extend_slices(nodes)
+            return
+        for node in nodes:
+            self.append(node)
+
+    def _extend_slices(self, slices):
+        """Append slices with the columns of the prototype encoded once."""
+        proto = slices.elem.copy()
+        proto['at'] = None
+        items = proto.args.items()
+        keys = tuple([key for key, value in items])
+        try:
+            shape = self._shape_ids[keys]
+        except KeyError:
+            shape = self._add_shape(keys)
+        roles = self._roles[shape]
+        values = self._arg_values
+        others = [values._encode(value)
+                  for role, (key, value) in zip(roles, items)
+                  if role == self.OTHER]
+        length = next((value for role, (key, value) in zip(roles, items)
+                       if role == self.L), None)
+        type = self._intern(proto.type)
+        prefix = slices.prefix
+        if prefix is not None:
+            name, number = self._split_number(prefix[:-2])
+        else:
+            name, number, slice_idx = self._split_name(
+                slices.name or proto.name)
+        for index, at in enumerate(slices.positions):
+            self._names.append(name)
+            self._numbers.append(number)
+            self._slice_index.append(slice_idx if prefix is None else index)
+            self._types.append(type)
+            self._shape_of.append(shape)
+            self._at.append(at)
+            self._length.append(length)
+            for code in others:
+                values._append_code(code)
+            self._arg_offsets.append(len(values))
+
+    def _add_shape(self, keys):
+        """Register a new tuple of argument names, return its id."""
+        shape = self._shape_ids[keys] = len(self._shapes)
+        roles = {'at': self.AT, 'l': self.L}
+        self._shapes.append(keys)
+        self._roles.append(tuple(roles.get(key.lower(), self.OTHER)
+                                 for key in keys))
+        return shape
+
+    def _intern(self, text):
+        """Get the string table id of a name or type."""
+        key = text if text is None else str(text)
+        try:
+            return self._string_ids[key]
+        except KeyError:
+            index = self._string_ids[key] = len(self._strings)
+            self._strings.append(key)
+            return index
+
+    def _split_name(self, name):
+        """Get the string ids of the prefix, trailing number, slice index."""
+        if name is None:
+            return 0, -1, -1
+        name = str(name)
+        match = regex.slice_index.search(name)
+        if match is None:
+            return self._split_number(name) + (-1,)
+        return (self._split_number(name[:match.start()]) +
+                (int(match.group(1)),))
+
+    def _split_number(self, name):
+        """Get the string id of the prefix and the trailing number."""
+        match = regex.trailing_number.search(name)
+        if match is None:
+            return self._intern(name), -1
+        return self._intern(name[:match.start()]), int(match.group())
+
+    def _name(self, row):
+        """Get the name of a row."""
+        name = self._strings[self._names[row]]
+        number = self._numbers[row]
+        if number >= 0:
+            name += str(number)
+        slice_idx = self._slice_index[row]
+        if slice_idx >= 0:
+            name += '..' + str(slice_idx)
+        return name
+
+    def _items(self, row):
+        """Get the arguments of a row as list of key-value pairs."""
+        values = map(self._arg_values.__getitem__,
+                     range(self._arg_offsets[row], self._arg_offsets[row+1]))
+        shape = self._shape_of[row]
+        items = []
+        for role, key in zip(self._roles[shape], self._shapes[shape]):
+            if role == self.AT:
+                items.append((key, self._at[row]))
+            elif role == self.L:
+                items.append((key, self._length[row]))
+            else:
+                items.append((key, next(values)))
+        return items
+
+    def _node(self, row):
+        """Create the Text or Element node for a row."""
+        name = self._name(row)
+        type = self._strings[self._types[row]]
+        if type is None:
+            return Text(name)
+        return Element(name, type, ArgDict(self._items(row)))
+
+    def _format(self, row):
+        """Format a row in MAD-X format, same as ``str(self._node(row))``."""
+        name = self._name(row)
+        type = self._strings[self._types[row]]
+        if type is None:
+            return name
+        return ''.join((
+            name + ': ' if name else '',
+            ', '.join([type] + [format_argument(k, v)
+                                for k, v in self._items(row)]),
+            ';'))
+
+
+class NumberColumn(object):
+
+    """
+    Column of numbers that stores common number types in machine words.
+
+    :ivar array _kinds: kind of each value, see :attr:`NONE` etc
+    :ivar array _data: value, scaled value or list index of each value
+    :ivar array _exponents: decimal exponent of each :class:`Decimal`
+    :ivar array _floats: float values, indexed by ``_data``
+    :ivar array _wide: high and low parts of decimals with more digits,
+                       indexed by ``_data``
+    :ivar list _objects: other values, indexed by ``_data``
+
+    ``int``, :class:`Fixed` and :class:`Decimal` values with up to 18
+    digits cost 10 bytes, ``float`` values and decimals with up to 36
+    digits (such as the results of a division) 18 or 26 bytes. Other
+    values, e.g. symbolic expressions, are stored as objects. Values are
+    read back with their original type, decimals also keep their exponent.
+    """
+
+    NONE, INT, FLOAT, DECIMAL, WIDE, FIXED, OBJECT = range(7)
+
+    def __init__(self, values=()):
+        self._kinds = array('b')
+        self._data = array('q')
+        self._exponents = array('b')
+        self._floats = array('d')
+        self._wide = array('q')
+        self._objects = []
+        self._last = self._last_code = None
+        for value in values:
+            self.append(value)
+
+    def __len__(self):
+        return len(self._kinds)
+
+    def __iter__(self):
+        return map(self.__getitem__, range(len(self._kinds)))
+
+    def __getitem__(self, row):
+        kind = self._kinds[row]
+        data = self._data[row]
+        if kind == self.DECIMAL:
+            return Decimal(data).scaleb(self._exponents[row])
+        if kind == self.WIDE:
+            high, low = self._wide[data:data+2]
+            return Decimal(high * 10**18 + low).scaleb(self._exponents[row])
+        if kind == self.FLOAT:
+            return self._floats[data]
+        if kind == self.INT:
+            return data
+        if kind == self.FIXED:
+            return Fixed._raw(data)
+        if kind == self.OBJECT:
+            return self._objects[data]
+        return None
+
+    def append(self, value):
+        """Append a value."""
+        # repeated values such as the lengths of slices are encoded once:
+        if value is not self._last or value is None:
+            self._last = value
+            self._last_code = self._encode(value)
+        self._append_code(self._last_code)
+
+    def _append_code(self, code):
+        """Append a value encoded by :meth:`_encode`."""
+        kind, data, exponent = code
+        self._kinds.append(kind)
+        self._data.append(data)
+        self._exponents.append(exponent)
+
+    def _encode(self, value):
+        """Get kind, data and exponent of a value."""
+        cls = value.__class__
+        if value is None:
+            return self.NONE, 0, 0
+        if cls is Decimal and value.is_finite():
+            exponent = value.as_tuple().exponent
+            data = int(value.scaleb(-exponent))
+            if (-128 <= exponent < 128 and abs(data) < 10**36 and
+                    (data or not value.is_signed())):
+                if abs(data) < 10**18:
+                    return self.DECIMAL, data, exponent
+                self._wide.extend(divmod(data, 10**18))
+                return self.WIDE, len(self._wide) - 2, exponent
+        elif cls is float:
+            self._floats.append(value)
+            return self.FLOAT, len(self._floats) - 1, 0
+        elif cls is int and abs(value) < 2**63:
+            return self.INT, value, 0
+        elif cls is Fixed and abs(value.value) < 2**63:
+            return self.FIXED, value.value, 0
+        self._objects.append(value)
+        return self.OBJECT, len(self._objects) - 1, 0
+
+
 #----------------------------------------
 # Transformations
 #----------------------------------------
 
+def _round_div(a, b):
+    """Integer division rounding to the nearest integer (ties to even)."""
+    q, r = divmod(a, b)
+    # the remainder has the sign of b:
+    r2 = 2 * r
+    if b < 0:
+        r2, b = -r2, -b
+    if r2 > b or (r2 == b and q % 2):
+        q += 1
+    return q
+
+
+class Fixed(object):
+
+    """
+    Fixed point number stored as an integer multiple of ``10**-digits``.
+
+    Cheap and exact alternative to :class:`Decimal` for adding positions.
+    Multiplication and division results are rounded to the nearest
+    representable number.
+
+    :ivar int value: scaled integer value
+    :cvar int digits: number of decimal places
+    """
+
+    __slots__ = ['value']
+
+    digits = 12
+    scale = 10**digits
+
+    def __init__(self, value=0):
+        """Convert int, Decimal, float or Fixed."""
+        if isinstance(value, Fixed):
+            self.value = value.value
+        elif isinstance(value, int):
+            self.value = value * self.scale
+        else:
+            if isinstance(value, float):
+                value = repr(value)
+            scaled = Decimal(value).scaleb(self.digits)
+            self.value = int(scaled.to_integral_value())
+
+    @classmethod
+    def _raw(cls, value):
+        """Create from scaled integer value."""
+        obj = cls.__new__(cls)
+        obj.value = value
+        return obj
+
+    def _scaled(self, other):
+        """Get scaled integer value of other number or ``None``."""
+        if isinstance(other, Fixed):
+            return other.value
+        if isinstance(other, int):
+            return other * self.scale
+        if isinstance(other, Decimal):
+            return Fixed(other).value
+        return None
+
+    def __add__(self, other):
+        other = self._scaled(other)
+        if other is None:
+            return NotImplemented
+        return self._raw(self.value + other)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        other = self._scaled(other)
+        if other is None:
+            return NotImplemented
+        return self._raw(self.value - other)
+
+    def __rsub__(self, other):
+        other = self._scaled(other)
+        if other is None:
+            return NotImplemented
+        return self._raw(other - self.value)
+
+    def __mul__(self, other):
+        if isinstance(other, int):
+            return self._raw(self.value * other)
+        other = self._scaled(other)
+        if other is None:
+            return NotImplemented
+        return self._raw(_round_div(self.value * other, self.scale))
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        if isinstance(other, int):
+            return self._raw(_round_div(self.value, other))
+        other = self._scaled(other)
+        if other is None:
+            return NotImplemented
+        return self._raw(_round_div(self.value * self.scale, other))
+
+    __div__ = __truediv__
+
+    def __neg__(self):
+        return self._raw(-self.value)
+
+    def __eq__(self, other):
+        other = self._scaled(other)
+        return other is not None and self.value == other
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __float__(self):
+        return self.value / self.scale
+
+    def to_decimal(self):
+        """Convert to exact :class:`Decimal`."""
+        return Decimal(self.value).scaleb(-self.digits)
+
+    @property
+    def expr(self):
+        """Format as decimal number without trailing zeros."""
+        sign = '-' if self.value < 0 else ''
+        integer, frac = divmod(abs(self.value), self.scale)
+        if not frac:
+            return sign + str(integer)
+        frac = str(frac).rjust(self.digits, '0').rstrip('0')
+        return '{0}{1}.{2}'.format(sign, integer, frac)
+
+    safe_expr = expr
+
+    def __str__(self):
+        return self.expr
+
+    def __repr__(self):
+        return 'Fixed({0!r})'.format(self.expr)
+
+
+# number types for the computation of positions and slice lengths:
+def to_number(number, value):
+    """Convert a numeric value to ``number``, keep symbolic expressions."""
+    if isinstance(value, Symbolic):
+        return value
+    return number(value)
+
+
+number_types = {
+    'decimal': Decimal,     # exact for terminating decimals, the default
+    'float': float,         # fastest, accumulates binary rounding errors
+    'fixed': Fixed,         # exact sums, rounded to Fixed.digits places
+    'numpy': float,         # float, slice positions computed by numpy
+}
+
+
 class SequenceTransform(object):
 
     """
     Sequence transformation constituted of Element transformation rules.
 
     :ivar list _transforms: list of :class:`ElementTransform`s
+    :ivar LRUCache slice_cache: prepared slices by element and rule
+    :ivar dict _by_name: index of the first rule for each element name
+    :ivar dict _by_type: index of the first rule for each base type
+    :ivar int _default: index of the first rule without selector
     :cvar dicti _offsets: associates numeric offset multipliers to offset names
     """
 
     _offsets = dicti(entry=0, centre=Decimal(1)/2, exit=1)
 
-    def __init__(self, slicing):
+    def __init__(self, slicing, cache_size=1024, arithmetic='decimal'):
         """
         Create transformation rules from the definition list.
 
         :param list slicing: list of :class:`ElementTransform` definitions
+        :param int cache_size: number of prepared elements to remember
+        :param str arithmetic: number type for positions, see
+                               :data:`number_types`
         """
-        self._transforms = [ElementTransform(s) for s in slicing] + []
-        self._transforms.append(ElementTransform({}))
+        try:
+            number = number_types[arithmetic]
+        except KeyError:
+            raise ValueError("Unknown arithmetic: {0!r}".format(arithmetic))
+        self._slicing = slicing
+        self._arithmetic = arithmetic
+        self._offsets = dicti((k, number(v)) for k, v in self._offsets.items())
+        self.slice_cache = LRUCache(cache_size)
+        vectorize = arithmetic == 'numpy'
+        self._transforms = [ElementTransform(s, number, vectorize)
+                            for s in slicing]
+        self._transforms.append(ElementTransform({}, number, vectorize))
+        # Index of the first rule for each (lowercase) name and type, and
+        # of the first rule matching any element. Only the first index is
+        # stored, because later rules can never win for the same key:
+        self._by_name = {}
+        self._by_type = {}
+        self._default = None
+        for index, t in enumerate(self._transforms):
+            if t.name is not None:
+                self._by_name.setdefault(str(t.name).lower(), index)
+            elif t.type is not None:
+                self._by_type.setdefault(str(t.type).lower(), index)
+            elif self._default is None:
+                self._default = index
+
+    def __reduce__(self):
+        """Pickle by definition, the rules themselves contain closures."""
+        return (self.__class__, (self._slicing, self.slice_cache.maxsize,
+                                 self._arithmetic))
 
     def __call__(self, node, defs):
 
@@ -573,57 +1861,201 @@ class SequenceTransform(object):
         Transform :class:`Sequence` according to the rule list.
 
         :param Sequence node: current sequence to transform
-        :param dict defs: element lookup table for base elements
+        :param Definitions defs: element lookup table for base elements
 
         If the ``node`` is not of type :class:`Sequence`, it will be
         returned unchanged, but may still be added to the ``defs`` lookup
-        table.
+        table. A :class:`ColumnarSequence` is transformed into a new
+        :class:`ColumnarSequence` without keeping the slices as objects.
         """
 
         if isinstance(node, Element):
+            base = resolve(defs, node.type)
             defs[str(node.name)] = node
-            node._base = defs.get(node.type)
+            node._base = base
         if not isinstance(node, Sequence):
             return node
 
         head = node.head.copy()
-        body = node.body
+        body = node.iter_body()
         tail = node.tail
 
         refer = self._offsets[str(head.get('refer', 'centre'))]
 
         def transform(elem, offset):
             if elem.type:
-                elem._base = defs.get(elem.type)
-            for t in self._transforms:
-                if t.match(elem):
-                    return t.slice(elem, offset, refer)
+                elem._base = resolve(defs, elem.type)
+            return self._slice(elem, offset, refer)
 
         templates = []      # predefined element templates
-        elements = []       # actual elements to put in sequence
         position = 0        # current element position
 
+        # actual elements to put in sequence:
+        if isinstance(node, ColumnarSequence):
+            elements = ColumnarSequence(head, (), tail, templates)
+        else:
+            elements = []
+
         for elem in body:
             if elem.type:
                 templ, elem, position = transform(elem, position)
                 templates += templ
-                elements += elem
+                elements.extend(elem)
             else:
                 elements.append(elem)
         head['L'] = position
 
-        if templates:
-            templates.insert(0, Text('! Template elements for %s:' % head.name))
-            templates.append(Text())
-
+        _frame_templates(templates, head)
+        if isinstance(elements, ColumnarSequence):
+            return elements
         return Sequence([head] + elements + [tail], templates)
 
+    def lazy(self, node, defs):
+
+        """
+        Transform :class:`Sequence` without building the list of slices.
+
+        :param Sequence node: current sequence to transform
+        :param Definitions defs: element lookup table for base elements
+        :returns: the transformed node
+        :rtype: LazySequence
+
+        Works like :meth:`__call__`, but the body of the returned sequence is
+        generated whenever it is iterated. A cheap first pass over the input
+        body computes the sequence length and collects the templates without
+        generating any slices.
+        """
+
+        if not isinstance(node, Sequence):
+            return self(node, defs)
+
+        head = node.head.copy()
+        tail = node.tail
+
+        refer = self._offsets[str(head.get('refer', 'centre'))]
+
+        templates = []
+        position = 0
+        # The body is iterated twice and may create new element objects each
+        # time (ColumnarSequence), so the bases are remembered by type:
+        bases = {}
+
+        # The slice generators returned by ElementTransform.slice are not
+        # consumed here, so this pass does not create any slice copies:
+        for elem in node.iter_body():
+            if elem.type:
+                elem._base = bases[str(elem.type).lower()] = \
+                    resolve(defs, elem.type)
+                templ, _, position = self._slice(elem, position, refer)
+                templates += templ
+        head['L'] = position
+
+        _frame_templates(templates, head)
+
+        def generate():
+            position = 0
+            for elem in node.iter_body():
+                if elem.type:
+                    elem._base = bases[str(elem.type).lower()]
+                    _, elems, position = self._slice(elem, position, refer)
+                    for slice in elems:
+                        yield slice
+                else:
+                    yield elem
+
+        return LazySequence(head, generate, tail, templates)
+
+    def _slice(self, elem, offset, refer):
+        """Slice the element using the first matching rule."""
+        rule = self._match(elem)
+        # Instances of the same definition with the same arguments share
+        # the position independent part of the result. Only the place of
+        # the AT argument enters the key, and the name only for templates.
+        # The base is stored in the value so its id can not be reused
+        # while cached:
+        key = (id(rule), id(elem._base), str(elem.type),
+               str(elem.name) if rule.template else None,
+               tuple('at' if k.lower() == 'at' else format_argument(k, v)
+                     for k, v in elem.args.items()))
+        _, prepared = self.slice_cache.get(
+            key, lambda: (elem._base, rule.prepare(elem)))
+        return rule.place(prepared, elem, offset, refer)
+
+    def dependencies(self, node, defs):
+        """
+        Get the inputs that the transformation of a sequence depends on.
+
+        :param Sequence node: sequence to transform
+        :param Definitions defs: element lookup table for base elements
+        :returns: lowercase names of the used definitions, number of rules
+                  up to and including the last one that matches an element
+        :rtype: tuple
+        """
+        names = set()
+        last = 0
+        for elem in node.iter_body():
+            if elem.type:
+                names.add(str(elem.type).lower())
+                elem._base = resolve(defs, elem.type)
+                last = max(last, self._match_index(elem))
+        return sorted(names), min(last + 1, len(self._slicing))
+
+    def fingerprint(self, node, defs):
+        """
+        Get a hash of all inputs that the transformed sequence depends on.
+
+        :param Sequence node: sequence to transform
+        :param Definitions defs: element lookup table for base elements
+        :returns: hex digest, used definitions, number of used rules
+        :rtype: tuple
+        """
+        import hashlib
+        names, rules = self.dependencies(node, defs)
+        parts = [__version__, self._arithmetic, str(node),
+                 repr(list(self._slicing[:rules]))]
+        parts += ['{0}: {1}'.format(name, resolve(defs, name))
+                  for name in names]
+        digest = hashlib.sha1()
+        for part in parts:
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest(), names, rules
+
+    def _match(self, elem):
+        """Return the first rule that matches the element."""
+        return self._transforms[self._match_index(elem)]
+
+    def _match_index(self, elem):
+        """Return the index of the first rule that matches the element."""
+        index = self._default
+        if self._by_name and elem.name:
+            found = self._by_name.get(elem.name.lower(), index)
+            if found < index:
+                index = found
+        if self._by_type:
+            found = self._by_type.get(elem.base_type.lower(), index)
+            if found < index:
+                index = found
+        return index
+
+
+def _frame_templates(templates, head):
+    """Add a comment header and a blank line around non-empty templates."""
+    if templates:
+        templates.insert(0, Text('! Template elements for %s:' % head.name))
+        templates.append(Text())
+
 
 class ElementTransform(object):
 
     """
     Single Element transformation rule.
 
+    :ivar name: element name selector or ``None``
+    :ivar type: element type selector or ``None``
+    :ivar bool template: whether a template is defined for the element
+    :ivar _number: number type for positions
+    :ivar _numpy: numpy module if positions are computed as arrays
     :ivar function match:
     :ivar function _get_position:
     :ivar function _get_slice_num:
@@ -633,21 +2065,27 @@ class ElementTransform(object):
     :ivar function _distribution:
     """
 
-    def __init__(self, selector):
+    def __init__(self, selector, number=Decimal, vectorize=False):
 
         """
         Create transformation rule from the serialized definition.
 
         :param dict selector:
+        :param number: number type for positions, see :data:`number_types`
+        :param bool vectorize: compute slice positions with numpy
         """
 
+        self._number = number
+        self._numpy = None
+
         # matching criterium
         exclusive(selector, 'name', 'type')
+        self.name = self.type = None
         if 'name' in selector:
-            name = selector['name']
+            name = self.name = selector['name']
             self.match = lambda elem: elem.name == name
         elif 'type' in selector:
-            type = selector['type']
+            type = self.type = selector['type']
             self.match = lambda elem: elem.base_type == type
         else:
             self.match = lambda elem: True
@@ -659,7 +2097,7 @@ class ElementTransform(object):
             # call:
             def _get_position(elem, elem_len, offset, refer):
                 try:
-                    return elem['at'] - elem_len * refer
+                    return to_number(number, elem['at']) - elem_len * refer
                 except KeyError:
                     return offset
             self._get_position = _get_position
@@ -682,7 +2120,8 @@ class ElementTransform(object):
             self._rescale = rescale_thick
 
         # whether to use separate optics
-        if selector.get('template', False):
+        self.template = bool(selector.get('template', False))
+        if self.template:
             self._maketempl = lambda elem: [elem]
             self._stripelem = lambda elem: Element(None, elem.name, {}, elem)
         else:
@@ -691,7 +2130,11 @@ class ElementTransform(object):
 
         # slice distribution style over element length
         style = selector.get('style', 'uniform')
-        if style == 'uniform':
+        if style == 'uniform' and vectorize:
+            import numpy
+            self._numpy = numpy
+            self._distribution = self.uniform_slice_array
+        elif style == 'uniform':
             self._distribution = self.uniform_slice_distribution
         elif style == 'loop':
             self._distribution = self.uniform_slice_loop
@@ -708,17 +2151,62 @@ class ElementTransform(object):
         :returns: template elements, element slices, element length
         :rtype: tuple
         """
+        return self.place(self.prepare(elem), elem, offset, refer)
+
+    def prepare(self, elem):
+        """
+        Compute the position independent part of the transformation.
+
+        The result does not depend on the name and AT value of the element,
+        except that templates are named after the element, so it can be
+        shared by all instances with the same arguments. The prototype keeps
+        the place of the AT argument (with value ``None``).
+
+        :param Element elem:
+        :returns: template elements, slice prototype, element length,
+                  number of slices, slice length
+        :rtype: tuple
+        """
+        elem = self._unplaced(elem)
         elem_len = elem.get('L', 0)
-        offset = self._get_position(elem, elem_len, offset, refer)
         slice_num = self._get_slice_num(elem_len) or 1
-        slice_len = Decimal(elem_len) / slice_num
-        scaled = self._rescale(elem, 1/Decimal(slice_num))
+        length = to_number(self._number, elem_len)
+        slice_len = length / slice_num
+        scaled = self._rescale(elem, self._number(1) / slice_num)
         templ = self._maketempl(scaled)
-        elem = self._stripelem(scaled)
-        elems = self._distribution(elem, offset, refer, slice_num, slice_len)
+        proto = self._stripelem(scaled)
+        return templ, proto, length, slice_num, slice_len
+
+    def _unplaced(self, elem):
+        """Copy the element without its AT value and name (unless needed)."""
+        if self.template:
+            args = ArgDict((k, v) for k, v in elem.args.items()
+                           if k.lower() != 'at')
+            return Element(elem.name, elem.type, args, elem._base)
+        args = ArgDict((k, None if k.lower() == 'at' else v)
+                       for k, v in elem.args.items())
+        return Element(None, elem.type, args, elem._base)
+
+    def place(self, prepared, elem, offset, refer):
+        """
+        Distribute the slices of a prepared element starting at ``offset``.
+
+        :param tuple prepared: result of :meth:`prepare` for ``elem``
+        :param Element elem:
+        :param Decimal offset: element entry position
+        :param Decimal refer: sequence addressing style
+        :returns: template elements, element slices, element length
+        :rtype: tuple
+        """
+        templ, proto, elem_len, slice_num, slice_len = prepared
+        offset = self._get_position(elem, elem_len, offset, refer)
+        name = None if self.template else elem.name
+        elems = self._distribution(proto, offset, refer, slice_num, slice_len,
+                                   name)
         return templ, elems, offset + elem_len
 
-    def uniform_slice_distribution(self, elem, offset, refer, slice_num, slice_len):
+    def uniform_slice_distribution(self, elem, offset, refer, slice_num,
+                                   slice_len, name=None):
         """
         Slice an element uniformly into short pieces.
 
@@ -727,17 +2215,45 @@ class ElementTransform(object):
         :param Decimal refer: sequence addressing style
         :param Decimal slice_len: element length
         :param int slice_num: number of slices
+        :param str name: element name, used as prefix for the slice names
         :returns: element slices
         :rtype: generator
         """
-        for slice_idx in range(slice_num):
-            slice = elem.copy()
-            slice['at'] = offset + (slice_idx + refer)*slice_len
-            if slice.name and slice_num > 1:
-                slice.name = elem.name + '..' + str(slice_idx)
-            yield slice
+        positions = (offset + (slice_idx + refer)*slice_len
+                     for slice_idx in range(slice_num))
+        return self._make_slices(elem, positions, slice_num, name)
 
-    def uniform_slice_loop(self, elem, offset, refer, slice_num, slice_len):
+    def uniform_slice_array(self, elem, offset, refer, slice_num, slice_len,
+                            name=None):
+        """
+        Slice an element uniformly, computing all positions at once.
+
+        Same as :meth:`uniform_slice_distribution` for float positions, but
+        the positions are computed as a numpy array.
+
+        :param Element elem:
+        :param float offset: element entry position
+        :param float refer: sequence addressing style
+        :param float slice_len: element length
+        :param int slice_num: number of slices
+        :param str name: element name, used as prefix for the slice names
+        :returns: element slices
+        :rtype: generator
+        """
+        if isinstance(offset, Symbolic) or isinstance(slice_len, Symbolic):
+            return self.uniform_slice_distribution(
+                elem, offset, refer, slice_num, slice_len, name)
+        numpy = self._numpy
+        positions = (numpy.arange(slice_num) + refer) * slice_len + offset
+        return self._make_slices(elem, positions.tolist(), slice_num, name)
+
+    @staticmethod
+    def _make_slices(elem, positions, slice_num, name=None):
+        """Get named copies of the slice prototype at the positions."""
+        return Slices(elem, positions, slice_num, name)
+
+    def uniform_slice_loop(self, elem, offset, refer, slice_num, slice_len,
+                           name=None):
         """
         Slice an element uniformly into short pieces using a loop construct.
 
@@ -746,6 +2262,7 @@ class ElementTransform(object):
         :param Decimal refer: sequence addressing style
         :param Decimal slice_len: element length
         :param int slice_num: number of slices
+        :param str name: ignored, the slice in the loop is not named
         :returns: element slices
         :rtype: generator
         """
@@ -759,15 +2276,68 @@ class ElementTransform(object):
         yield Text('}')
 
 
+class Slices(object):
+
+    """
+    Named copies of a slice prototype at some positions.
+
+    :ivar Element elem: slice prototype
+    :ivar positions: iterable of AT values
+    :ivar int slice_num: number of slices
+    :ivar str name: element name, used as prefix for the slice names
+
+    Iterating creates the slices as :class:`Element` objects. A
+    :class:`ColumnarSequence` stores them without creating the objects.
+    """
+
+    def __init__(self, elem, positions, slice_num, name=None):
+        self.elem = elem
+        self.positions = positions
+        self.slice_num = slice_num
+        self.name = name
+
+    @property
+    def prefix(self):
+        """Get the prefix of the slice names, ``None`` for a single name."""
+        if self.name and self.slice_num > 1:
+            return self.name + '..'
+        return None
+
+    def __iter__(self):
+        prefix = self.prefix
+        name = self.name
+        for slice_idx, at in enumerate(self.positions):
+            slice = self.elem.copy()
+            slice['at'] = at
+            if prefix is not None:
+                slice.name = prefix + str(slice_idx)
+            elif name:
+                slice.name = name
+            yield slice
+
+
+def scale_value(value, ratio):
+    """
+    Multiply an argument value by the ratio.
+
+    Parsed :class:`Decimal` values are converted to the number type of the
+    ratio first (see :data:`number_types`), since ``float`` and
+    :class:`Decimal` can not be mixed.
+    """
+    if isinstance(value, Decimal) and not isinstance(ratio, Decimal):
+        value = to_number(ratio.__class__, value)
+    return value * ratio
+
+
 def rescale_thick(elem, ratio):
     """Shrink/grow element size, while leaving the element type 'as is'."""
     # TODO: implement this for all sorts of elements..
     if ratio == 1:
         return elem
     scaled = elem.copy()
-    scaled['L'] = elem['L'] * ratio
+    scaled['L'] = scale_value(elem['L'], ratio)
     if scaled.base_type == 'sbend':
-        scaled['angle'] = scaled['angle'] * ratio
+        scaled['angle'] = scale_value(scaled['angle'], ratio)
     return scaled
 
 
@@ -787,23 +2357,23 @@ def rescale_makethin(elem, ratio):
         return elem
     if base_type == 'solenoid':
         elem = elem.copy()
-        elem['ksi'] = elem['KS'] * elem['L'] * ratio
-        elem['lrad'] = elem['L'] * ratio
+        elem['ksi'] = scale_value(elem['KS'] * elem['L'], ratio)
+        elem['lrad'] = scale_value(elem['L'], ratio)
         elem['L'] = 0
         return elem
     elem = Element(elem.name, 'multipole', elem.all_args)
     if base_type == 'sbend':
-        elem['KNL'] = [elem.pop('angle') * ratio]
+        elem['KNL'] = [scale_value(elem.pop('angle'), ratio)]
         elem.pop('HGAP', None)
     elif base_type == 'quadrupole':
         if 'K1' in elem:
-            elem['KNL'] = [0, elem['K1'] * elem['L'] * ratio]
+            elem['KNL'] = [0, scale_value(elem['K1'] * elem['L'], ratio)]
             del elem['K1']
         if 'K1S' in elem:
-            elem['KSL'] = [0, elem['K1S'] * elem['L'] * ratio]
+            elem['KSL'] = [0, scale_value(elem['K1S'] * elem['L'], ratio)]
             del elem['K1S']
     if 'L' in elem:
-        elem['lrad'] = elem.pop('L') * ratio
+        elem['lrad'] = scale_value(elem.pop('L'), ratio)
     return elem
 
 
@@ -816,86 +2386,860 @@ def exclusive(mapping, *keys):
 # Serialization
 #----------------------------------------
 
+def _exact_float(value):
+    """
+    Format a :class:`Decimal` or :class:`Fixed` with all its digits as a
+    floating point literal, e.g. ``20.0`` instead of ``2E+1``.
+    """
+    if isinstance(value, Fixed):
+        text = value.expr
+    else:
+        value = value.normalize()
+        text = str(value)
+        if 'E+' in text and value.adjusted() < 16:
+            text = '{0:f}'.format(value)
+    if text.isdigit() or text[1:].isdigit():
+        return text + '.0'
+    return text
+
+
+class BufferedWriter(object):
+
+    """
+    Collect written text and pass it on to the stream in large chunks.
+
+    :ivar stream: output file object
+    :ivar int size: number of characters to collect before writing
+    """
+
+    def __init__(self, stream, size=2**16):
+        """Wrap the output stream."""
+        self.stream = stream
+        self.size = size
+        self._parts = []
+        self._length = 0
+
+    def write(self, text):
+        """Add text to the buffer and write it out when the buffer is full."""
+        self._parts.append(text)
+        self._length += len(text)
+        if self._length >= self.size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered text to the stream."""
+        if self._parts:
+            self.stream.write(''.join(self._parts))
+            self._parts = []
+            self._length = 0
+
+
 class Json(object):
 
-    """JSON serialization utility."""
+    """
+    JSON serialization utility.
+
+    :ivar str style: output layout, one of :attr:`styles`
+
+    Values are formatted directly to JSON text, so that :class:`Decimal` and
+    :class:`Fixed` numbers keep all their digits. The ``'pretty'`` style indents nested
+    containers by two spaces, ``'compact'`` writes everything on one line
+    and ``'ndjson'`` writes one line per sequence header and element when
+    dumping sequences.
+    """
 
-    def __init__(self):
+    styles = ('pretty', 'compact', 'ndjson')
+
+    def __init__(self, style='pretty'):
         """Import json module for later use."""
         import json
+        import json.encoder
+        if style not in self.styles:
+            raise ValueError("Invalid JSON style: {0!r}".format(style))
         self.json = json
+        self.style = style
+        self._encode_str = json.encoder.encode_basestring_ascii
+        self._formatters = {
+            type(None): lambda value, level: 'null',
+            bool: lambda value, level: 'true' if value else 'false',
+            int: lambda value, level: int.__repr__(value),
+            float: lambda value, level: self._format_float(value),
+            Decimal: lambda value, level: _exact_float(value),
+            Fixed: lambda value, level: _exact_float(value),
+            str: lambda value, level: self._encode_str(value),
+            stri.cls: lambda value, level: self._encode_str(value),
+            list: self._format_list,
+            tuple: self._format_list,
+            odicti: self._format_dict,
+            dict: self._format_dict,
+        }
+        if style == 'pretty':
+            self._sep, self._key_sep = ',', ' : '
+        else:
+            self._sep, self._key_sep = ',', ':'
 
     def dump(self, data, stream):
         """Dump data with types defined in this module."""
-        json = self.json
-        class fakefloat(float):
-            """Used to serialize Decimal.
-            See: http://stackoverflow.com/a/8274307/650222"""
-            def __init__(self, value):
-                self._value = value
-            def __repr__(self):
-                return str(self._value)
-        class ValueEncoder(json.JSONEncoder):
-            def default(self, obj):
-                if isinstance(obj, Value):
-                    return obj.value
-                if isinstance(obj, Decimal):
-                    return fakefloat(obj.normalize())
-                # Let the base class default method raise the TypeError
-                return json.JSONEncoder.default(self, obj)
-        json.dump(data, stream,
-                  indent=2,
-                  separators=(',', ' : '),
-                  cls=ValueEncoder)
+        stream.write(self.format(data))
 
-    def load(self, stream):
+    def dump_sequences(self, sequences, stream):
+        """
+        Dump sequences one element at a time.
+
+        The output is the same as :meth:`dump` of ``Document._getstate()``,
+        but only a single element is converted to JSON at a time. With the
+        ``'ndjson'`` style, each sequence is written as a line with the
+        sequence name and the sequence arguments, followed by one line for
+        each element.
+
+        :param sequences: iterable of :class:`Sequence`
+        :param stream: output file object
+        """
+        if self.style == 'ndjson':
+            self._dump_lines(sequences, stream)
+            return
+        pretty = self.style == 'pretty'
+        def newline(level):
+            return '\n' + '  ' * level if pretty else ''
+        fmt = self.format
+        key_sep = self._key_sep
+        write = stream.write
+        write('{')
+        first = True
+        for seq in sequences:
+            write(('' if first else ',') + newline(1) +
+                  fmt(seq.name) + key_sep + '{')
+            for key, value in seq.head.args.items():
+                write(newline(2) + fmt(key) + key_sep + fmt(value, 2) + ',')
+            write(newline(2) + '"elements"' + key_sep + '[')
+            empty = True
+            for elem in seq.iter_body():
+                if elem.type:
+                    write(('' if empty else ',') + newline(3) +
+                          fmt(elem._getstate(), 3))
+                    empty = False
+            write((']' if empty else newline(2) + ']') + newline(1) + '}')
+            first = False
+        write('}' if first else newline(0) + '}')
+
+    def _dump_lines(self, sequences, stream):
+        """Dump sequences in newline delimited JSON."""
+        fmt = self.format
+        for seq in sequences:
+            stream.write(fmt(odicti([('sequence', seq.name)] +
+                                    list(seq.head.args.items()))) + '\n')
+            for elem in seq.iter_body():
+                if elem.type:
+                    stream.write(fmt(elem._getstate()) + '\n')
+
+    def format(self, value, level=0):
+        """
+        Format a value as JSON text.
+
+        :param value: builtin or madseq value
+        :param int level: indentation level of the value (``'pretty'``)
+        :rtype: str
+        :raises TypeError: if the value can not be represented in JSON
+        """
+        formatter = self._formatters.get(type(value))
+        if formatter is None:
+            if isinstance(value, Value):
+                return self.format(value.value, level)
+            for cls in (str, bool, int, float, Decimal, list, tuple, Mapping):
+                if isinstance(value, cls):
+                    formatter = self._formatters[dict if cls is Mapping
+                                                 else cls]
+                    break
+            else:
+                raise TypeError("{0!r} is not JSON serializable"
+                                .format(value))
+        return formatter(value, level)
+
+    def _format_float(self, value):
+        """Format a float the same way as the json module."""
+        if value != value:
+            return 'NaN'
+        if value in (float('inf'), float('-inf')):
+            return 'Infinity' if value > 0 else '-Infinity'
+        return float.__repr__(value)
+
+    def _format_list(self, value, level):
+        """Format a list or tuple as JSON array."""
+        if not value:
+            return '[]'
+        fmt = self.format
+        if self.style != 'pretty':
+            return '[' + self._sep.join(fmt(item) for item in value) + ']'
+        indent = '\n' + '  ' * (level + 1)
+        return ('[' + indent +
+                (self._sep + indent).join(fmt(item, level + 1)
+                                          for item in value) +
+                '\n' + '  ' * level + ']')
+
+    def _format_dict(self, value, level):
+        """Format a mapping as JSON object."""
+        if not value:
+            return '{}'
+        fmt = self.format
+        key_sep = self._key_sep
+        items = [fmt(self._format_key(key)) + key_sep + fmt(item, level + 1)
+                 for key, item in value.items()]
+        if self.style != 'pretty':
+            return '{' + self._sep.join(items) + '}'
+        indent = '\n' + '  ' * (level + 1)
+        return ('{' + indent + (self._sep + indent).join(items) +
+                '\n' + '  ' * level + '}')
+
+    @staticmethod
+    def _format_key(key):
+        """Convert a mapping key to str like the json module."""
+        if isinstance(key, str):
+            return key
+        if key is None or isinstance(key, bool):
+            return {None: 'null', True: 'true', False: 'false'}[key]
+        if isinstance(key, (int, float, Decimal)):
+            return str(key)
+        raise TypeError("keys must be str, int, float, bool or None, "
+                        "not {0}".format(type(key).__name__))
+
+    def load(self, stream, parse_float=float):
         """Load data from, using ordered case insensitive dictionaries."""
-        return self.json.load(stream, object_pairs_hook=odicti)
+        return self.json.load(stream, object_pairs_hook=odicti,
+                              parse_float=parse_float)
 
 
 class Yaml(object):
 
-    """YAML serialization utility."""
+    """
+    YAML serialization utility.
+
+    :ivar str style: output layout, one of :attr:`styles`
+
+    The libyaml based ``CSafeDumper`` and ``CSafeLoader`` are used if they
+    are available. The dumper and loader classes are created only once.
+    With the ``'documents'`` style, :meth:`dump_sequences` writes each
+    sequence as a separate YAML document.
+    """
 
-    def __init__(self):
+    styles = ('mapping', 'documents')
+
+    _Dumper = None
+    _loaders = {}
+
+    def __init__(self, style='mapping'):
         """Import yaml module for later use."""
         import yaml
+        if style not in self.styles:
+            raise ValueError("Invalid YAML style: {0!r}".format(style))
         self.yaml = yaml
+        self.style = style
 
     def dump(self, data, stream=None):
         """Dump data with types defined in this module."""
+        return self.yaml.dump(data, stream, self._dumper(),
+                              default_flow_style=False)
+
+    def dump_sequences(self, sequences, stream):
+        """
+        Dump sequences one element at a time.
+
+        The output is the same as :meth:`dump` of ``Document._getstate()``,
+        but only a single element is represented as YAML nodes at a time.
+
+        :param sequences: iterable of :class:`Sequence`
+        :param stream: output file object
+        """
         yaml = self.yaml
-        class Dumper(yaml.SafeDumper):
-            pass
+        dumper = self._dumper()(stream, default_flow_style=False)
+        emit = dumper.emit
+        def emit_data(data):
+            self._emit_node(dumper, dumper.represent_data(data))
+            dumper.represented_objects = {}
+            dumper.object_keeper = []
+        def start_mapping():
+            emit(yaml.MappingStartEvent(
+                None, yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, True,
+                flow_style=False))
+        documents = self.style == 'documents'
+        try:
+            dumper.open()
+            if not documents:
+                emit(yaml.DocumentStartEvent())
+                start_mapping()
+            for seq in sequences:
+                if documents:
+                    emit(yaml.DocumentStartEvent())
+                    start_mapping()
+                emit_data(seq.name)
+                start_mapping()
+                for key, value in seq.head.args.items():
+                    emit_data(key)
+                    emit_data(value)
+                emit_data('elements')
+                emit(yaml.SequenceStartEvent(
+                    None, yaml.resolver.BaseResolver.DEFAULT_SEQUENCE_TAG,
+                    True, flow_style=False))
+                for elem in seq.iter_body():
+                    if elem.type:
+                        emit_data(elem._getstate())
+                emit(yaml.SequenceEndEvent())
+                emit(yaml.MappingEndEvent())
+                if documents:
+                    emit(yaml.MappingEndEvent())
+                    emit(yaml.DocumentEndEvent())
+            if not documents:
+                emit(yaml.MappingEndEvent())
+                emit(yaml.DocumentEndEvent())
+            dumper.close()
+        finally:
+            dumper.dispose()
+
+    def _emit_node(self, dumper, node):
+        """Emit the events of a represented node without anchors."""
+        yaml = self.yaml
+        if isinstance(node, yaml.ScalarNode):
+            implicit = (
+                node.tag == dumper.resolve(yaml.ScalarNode, node.value,
+                                           (True, False)),
+                node.tag == dumper.resolve(yaml.ScalarNode, node.value,
+                                           (False, True)))
+            dumper.emit(yaml.ScalarEvent(None, node.tag, implicit,
+                                         node.value, style=node.style))
+        elif isinstance(node, yaml.SequenceNode):
+            implicit = node.tag == dumper.resolve(yaml.SequenceNode,
+                                                  node.value, True)
+            dumper.emit(yaml.SequenceStartEvent(None, node.tag, implicit,
+                                                flow_style=node.flow_style))
+            for item in node.value:
+                self._emit_node(dumper, item)
+            dumper.emit(yaml.SequenceEndEvent())
+        else:
+            implicit = node.tag == dumper.resolve(yaml.MappingNode,
+                                                  node.value, True)
+            dumper.emit(yaml.MappingStartEvent(None, node.tag, implicit,
+                                               flow_style=node.flow_style))
+            for key, value in node.value:
+                self._emit_node(dumper, key)
+                self._emit_node(dumper, value)
+            dumper.emit(yaml.MappingEndEvent())
+
+    def _dumper(self):
+        """Get the dumper class for the types defined in this module."""
+        if Yaml._Dumper is not None:
+            return Yaml._Dumper
+        yaml = self.yaml
+        SafeDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+        class Dumper(SafeDumper):
+            def ignore_aliases(self, data):
+                # numbers are shared between elements, but should not be
+                # written as anchors:
+                return (isinstance(data, (Decimal, Fixed, Value)) or
+                        SafeDumper.ignore_aliases(self, data))
         def _dict_representer(dumper, data):
             return dumper.represent_mapping(
                 yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
                 data.items())
         def _stri_representer(dumper, data):
-            return dumper.represent_str(data)
+            return dumper.represent_str(str(data))
         def _Value_representer(dumper, data):
-            return dumper.represent_str(data.value)
+            return dumper.represent_str(str(data.value))
+        def _Array_representer(dumper, data):
+            return dumper.represent_list(data.value)
         def _Decimal_representer(dumper, data):
             return dumper.represent_scalar(u'tag:yaml.org,2002:float',
-                                           str(data).lower())
+                                           _exact_float(data).lower())
         Dumper.add_representer(odicti, _dict_representer)
         Dumper.add_representer(stri.cls, _stri_representer)
         Dumper.add_representer(Symbolic, _Value_representer)
         Dumper.add_representer(Identifier, _Value_representer)
         Dumper.add_representer(Composed, _Value_representer)
-        Dumper.add_representer(Array, _Value_representer)
+        Dumper.add_representer(Array, _Array_representer)
         Dumper.add_representer(Decimal, _Decimal_representer)
-        return yaml.dump(data, stream, Dumper, default_flow_style=False)
+        Dumper.add_representer(Fixed, _Decimal_representer)
+        Yaml._Dumper = Dumper
+        return Dumper
 
-    def load(self, stream):
-        """Load data from, using ordered case insensitive dictionaries."""
+    def load(self, stream, exact=False):
+        """
+        Load data from, using ordered case insensitive dictionaries.
+
+        If ``exact`` is true, floats are loaded as :class:`Decimal`.
+        """
+        return self.yaml.load(stream, self._loader(exact))
+
+    def _loader(self, exact=False):
+        """Get the loader class that creates ordered dictionaries."""
+        if exact in Yaml._loaders:
+            return Yaml._loaders[exact]
         yaml = self.yaml
-        class OrderedLoader(yaml.SafeLoader):
+        class OrderedLoader(getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
             pass
         OrderedLoader.add_constructor(
             yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
             lambda loader, node: odicti(loader.construct_pairs(node)))
-        return yaml.load(stream, OrderedLoader)
+        if exact:
+            def _Decimal_constructor(loader, node):
+                try:
+                    return Decimal(loader.construct_scalar(node))
+                except InvalidOperation:    # e.g. .inf or 1_000.0
+                    return loader.construct_yaml_float(node)
+            OrderedLoader.add_constructor(u'tag:yaml.org,2002:float',
+                                          _Decimal_constructor)
+        Yaml._loaders[exact] = OrderedLoader
+        return OrderedLoader
+
+
+class Binary(object):
+
+    """
+    Binary serialization utility.
+
+    Each sequence is stored as typed arrays: element names and types as
+    indices into a string table, and one column per argument name with the
+    kind of each value, its number (``NaN`` if not numeric) and its string
+    table index (``-1`` if not text). Symbolic values are stored as MAD-X
+    expressions in the string table.
+
+    The file starts with :attr:`magic`, followed by the arrays in little
+    endian byte order, each aligned to 8 bytes. It ends with a JSON header
+    that describes the arrays, the size of the header as 8 byte integer and
+    :attr:`magic` again, so that the arrays can be written while the
+    sequences are generated and read without decoding the rest of the file.
+    """
+
+    magic = b'MADSEQB1'
+
+    # value kinds:
+    MISSING, FLOAT, INT, CONSTANT, EXPRESSION = range(5)
+
+    def dump_sequences(self, sequences, stream):
+        """
+        Dump sequences to a binary stream.
+
+        Numbers are stored as 64 bit floats, so :class:`Decimal` positions
+        are rounded.
+
+        :param sequences: iterable of :class:`Sequence`
+        :param stream: binary output file object
+        """
+        import json
+        writer = _ArrayWriter(stream)
+        writer.write(self.magic)
+        strings = OrderedDict()
+        def intern(text):
+            text = str(text)
+            index = strings.get(text)
+            if index is None:
+                index = strings[text] = len(strings)
+            return index
+        header = []
+        for seq in sequences:
+            header.append(self._dump_sequence(seq, writer, intern))
+        data = ''.join(strings).encode('utf-8')
+        offsets = array('q', [0])
+        for text in strings:
+            offsets.append(offsets[-1] + len(text.encode('utf-8')))
+        meta = json.dumps({'sequences': header,
+                           'strings': writer.write_array(offsets),
+                           'string_data': writer.write_array(data)},
+                          separators=(',', ':')).encode('utf-8')
+        writer.write(meta)
+        writer.write(array('q', [len(meta)]))
+        writer.write(self.magic)
+
+    def _dump_sequence(self, seq, writer, intern):
+        """Write the arrays of a sequence and return its header."""
+        nan = float('nan')
+        names = array('i')
+        types = array('i')
+        columns = OrderedDict()
+        count = 0
+        for elem in seq.iter_body():
+            if not elem.type:
+                continue
+            names.append(-1 if elem.name is None else intern(elem.name))
+            types.append(intern(elem.type))
+            for key, value in elem.args.items():
+                column = columns.get(key.lower())
+                if column is None:
+                    column = columns[key.lower()] = (
+                        str(key), array('B', [0] * count),
+                        array('d', [nan] * count), array('i', [-1] * count))
+                kind, number, text = self._encode(value, intern)
+                column[1].append(kind)
+                column[2].append(number)
+                column[3].append(text)
+            count += 1
+            for column in columns.values():
+                if len(column[1]) < count:
+                    column[1].append(self.MISSING)
+                    column[2].append(nan)
+                    column[3].append(-1)
+        head = []
+        for key, value in seq.head.args.items():
+            kind, number, text = self._encode(value, str)
+            head.append((str(key), kind,
+                         number if kind in (self.INT, self.FLOAT) else None,
+                         text))
+        return {
+            'name': str(seq.name),
+            'head': head,
+            'count': count,
+            'names': writer.write_array(names),
+            'types': writer.write_array(types),
+            'args': [{'key': key,
+                      'kinds': writer.write_array(kinds),
+                      'numbers': writer.write_array(numbers),
+                      'texts': writer.write_array(texts)}
+                     for key, kinds, numbers, texts in columns.values()],
+        }
+
+    def _encode(self, value, intern):
+        """Get the kind, number and text (index) of an argument value."""
+        if isinstance(value, Value):
+            kind = self.EXPRESSION if value._assign == ':=' else self.CONSTANT
+            return kind, float('nan'), intern(value.expr)
+        if isinstance(value, int) and abs(value) < 2**53:
+            return self.INT, float(value), -1
+        if isinstance(value, (float, Decimal, Fixed)):
+            return self.FLOAT, float(value), -1
+        return self.CONSTANT, float('nan'), intern(format_value(value))
+
+    def load(self, stream):
+        """
+        Load data from a binary stream.
+
+        :returns: same structure as ``Document._getstate()``
+        :rtype: odicti
+        """
+        return self.loads(stream.read())
+
+    def loads(self, data):
+        """Load data from a bytes-like object, see :meth:`load`."""
+        result = odicti()
+        for name, state, elements in self.iter_sequences(data):
+            state['elements'] = [
+                odicti([('name', elem_name), ('type', elem_type)] +
+                       list(zip(keys, values)))
+                for elem_name, elem_type, keys, values in elements()]
+            result[name] = state
+        return result
+
+    def iter_sequences(self, data):
+        """
+        Iterate over the sequences without decoding their elements.
+
+        :param data: bytes-like object, e.g. a memory map of the file
+        :returns: sequence name, sequence arguments and a function that
+                  returns a list of ``(name, type, keys, values)`` for the
+                  elements
+        :rtype: generator
+        """
+        header = self._header(data)
+        view = memoryview(data)
+        offsets = _read_array(view, header['strings'])
+        raw = bytes(_read_array(view, header['string_data']))
+        strings = [raw[offsets[i]:offsets[i+1]].decode('utf-8')
+                   for i in range(len(offsets) - 1)]
+        strings.append(None)    # index -1 means no string
+        for seq in header['sequences']:
+            state = odicti((stri(key), self._decode(kind, number, text))
+                           for key, kind, number, text in seq['head'])
+            yield (seq['name'], state,
+                   partial(self._load_elements, view, seq, strings))
+
+    def _load_elements(self, view, seq, strings):
+        """Get the elements of one sequence from its arrays."""
+        names = [strings[i] for i in _read_array(view, seq['names'])]
+        types = [strings[i] for i in _read_array(view, seq['types'])]
+        columns = [(stri(arg['key']),
+                    _read_array(view, arg['kinds']).tolist(),
+                    _read_array(view, arg['numbers']).tolist(),
+                    _read_array(view, arg['texts']).tolist())
+                   for arg in seq['args']]
+        elements = []
+        for i in range(seq['count']):
+            keys = []
+            values = []
+            for key, kinds, numbers, texts in columns:
+                kind = kinds[i]
+                if kind == self.FLOAT:
+                    keys.append(key)
+                    values.append(numbers[i])
+                elif kind != self.MISSING:
+                    keys.append(key)
+                    values.append(self._decode(kind, numbers[i],
+                                               strings[texts[i]]))
+            elements.append((names[i], types[i], keys, values))
+        return elements
+
+    def _decode(self, kind, number, text):
+        """Get an argument value from its kind, number and text."""
+        if kind == self.INT:
+            return int(number)
+        if kind == self.FLOAT:
+            return number
+        return Value.parse(text, ':=' if kind == self.EXPRESSION else '=')
+
+    def positions(self, filename, name):
+        """
+        Get the ``at`` positions of a sequence without decoding the file.
+
+        The positions are returned as a view of a read-only memory map of
+        the file, e.g. ``numpy.frombuffer(positions)`` creates an array
+        without copying them. Elements without numeric position are ``NaN``.
+
+        :param str filename: binary file name
+        :param str name: sequence name
+        :rtype: memoryview
+        :raises KeyError: if there is no such sequence or no ``at`` column
+        """
+        import mmap
+        with open(filename, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        for seq in self._header(data)['sequences']:
+            if seq['name'].lower() == name.lower():
+                for arg in seq['args']:
+                    if arg['key'].lower() == 'at':
+                        return _read_array(memoryview(data), arg['numbers'])
+        raise KeyError(name)
+
+    def _header(self, data):
+        """Decode the JSON header at the end of the file."""
+        import json, struct
+        size = len(data)
+        magic = len(self.magic)
+        if (bytes(data[:magic]) != self.magic or
+                bytes(data[size-magic:]) != self.magic):
+            raise ValueError("Not a madseq binary file")
+        meta_size, = struct.unpack('<q', data[size-magic-8:size-magic])
+        meta = bytes(data[size-magic-8-meta_size:size-magic-8])
+        return json.loads(meta.decode('utf-8'))
+
+
+class _ArrayWriter(object):
+
+    """Write arrays aligned to 8 bytes and keep track of the offset."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.offset = 0
+
+    def write(self, data):
+        """Write an array or bytes object."""
+        if isinstance(data, array):
+            if sys.byteorder == 'big':
+                data = array(data.typecode, data)
+                data.byteswap()
+            data = data.tobytes()
+        self.stream.write(data)
+        self.offset += len(data)
+
+    def write_array(self, data):
+        """Write aligned array and return its description for the header."""
+        padding = -self.offset % 8
+        if padding:
+            self.write(b'\0' * padding)
+        offset = self.offset
+        self.write(data)
+        typecode = data.typecode if isinstance(data, array) else 'B'
+        return {'type': typecode, 'offset': offset, 'count': len(data)}
+
+
+def _read_array(view, desc):
+    """Get an array described in the header of a binary file as memoryview."""
+    itemsize = array(desc['type']).itemsize
+    start = desc['offset']
+    data = view[start:start + itemsize * desc['count']]
+    if sys.byteorder == 'big':
+        data = array(desc['type'], data.tobytes())
+        data.byteswap()
+        return memoryview(data)
+    return data.cast(desc['type'])
+
+
+class ParseCache(object):
+
+    """
+    On-disk cache of parsed documents.
+
+    :ivar str path: cache directory
+    :ivar int max_size: maximum total size of the cache files in bytes
+    :cvar int format_version: version of the encoding of the cache files,
+                              must be increased when :func:`_encode_node`
+                              changes
+
+    The cache files are named after a hash of the input text, the madseq
+    version, the format version and the python version, and contain the
+    parsed nodes encoded as builtin types in :mod:`marshal` format. The
+    least recently used files are removed when the total size exceeds
+    ``max_size``. Files are written under a temporary name first, leftovers
+    of interrupted writes are removed after ``stale_time`` seconds.
+    """
+
+    suffix = '.cache'
+    temp_suffix = '.cache-tmp'
+    stale_time = 3600
+    format_version = 1
+
+    def __init__(self, path, max_size=1 << 30):
+        """Set cache directory and maximum size in bytes."""
+        self.path = path
+        self.max_size = max_size
+
+    def key(self, text):
+        """Get the cache key for the input text."""
+        import hashlib
+        header = '{0}\0{1}\0{2}.{3}\0'.format(
+            __version__, self.format_version, *sys.version_info[:2])
+        digest = hashlib.sha1(header.encode('utf-8'))
+        digest.update(text.encode('utf-8'))
+        return digest.hexdigest()
+
+    def parse(self, text, columnar=False):
+        """
+        Get the document for the input text from the cache or parse it.
+
+        :param str text: MAD-X input
+        :param bool columnar: store sequences as :class:`ColumnarSequence`
+        :rtype: Document
+        """
+        key = self.key(text)
+        nodes = self.load(key)
+        if nodes is None:
+            nodes = Document.parse(text.splitlines(True))._nodes
+            self.store(key, nodes)
+        if columnar:
+            nodes = _columnar(nodes)
+        return Document(nodes)
+
+    def load(self, key):
+        """Load the nodes stored under the key or return ``None``."""
+        import gc, marshal, os
+        filename = os.path.join(self.path, key + self.suffix)
+        # The garbage collector would repeatedly scan the many new objects
+        # in vain, which takes longer than creating them:
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with open(filename, 'rb') as f:
+                data = marshal.loads(f.read())
+            # mark as recently used:
+            os.utime(filename, None)
+            return [_decode_node(node) for node in data]
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def store(self, key, nodes):
+        """Store the nodes under the key and remove old cache files."""
+        import marshal, os, tempfile
+        data = [_encode_node(node) for node in nodes]
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        f = tempfile.NamedTemporaryFile(dir=self.path, delete=False,
+                                        suffix=self.temp_suffix)
+        try:
+            with f:
+                marshal.dump(data, f)
+            getattr(os, 'replace', os.rename)(
+                f.name, os.path.join(self.path, key + self.suffix))
+        except:
+            os.remove(f.name)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used files while above max_size, and
+        temporary files that were left over by interrupted writes.
+        """
+        import os, time
+        files = []
+        stale = time.time() - self.stale_time
+        for name in os.listdir(self.path):
+            filename = os.path.join(self.path, name)
+            if name.endswith(self.suffix):
+                stat = os.stat(filename)
+                files.append((stat.st_mtime, stat.st_size, filename))
+            elif name.endswith(self.temp_suffix):
+                try:
+                    if os.stat(filename).st_mtime < stale:
+                        os.remove(filename)
+                except OSError:     # removed by another process
+                    pass
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for _, size, filename in files:
+            if total <= self.max_size:
+                break
+            os.remove(filename)
+            total -= size
+
+
+def _encode_node(node):
+    """Convert a Text/Element/Sequence node to builtin types."""
+    if isinstance(node, Sequence):
+        return ([[_encode_node(n) for n in node._preface]] +
+                [_encode_node(n) for n in chain([node.head],
+                                                node.iter_body(),
+                                                [node.tail])])
+    if not node.type:
+        return str(node)
+    keys = [str(key) for key in node.args]
+    return (None if node.name is None else str(node.name),
+            str(node.type),
+            [key.lower() for key in keys],
+            keys,
+            [_encode_value(node.args[key]) for key in keys])
+
+
+def _decode_node(data):
+    """Create a Text/Element/Sequence node from :func:`_encode_node`."""
+    if data.__class__ is str:
+        return Text(data)
+    if data.__class__ is list:
+        return Sequence([_decode_node(n) for n in data[1:]],
+                        [_decode_node(n) for n in data[0]])
+    name, type, lower, keys, values = data
+    values = [_decode_value(v) if v.__class__ is tuple else v
+              for v in values]
+    return Element(name, type, ArgDict._from_lists(lower, keys, values))
+
+
+def _encode_value(value):
+    """Convert an argument value to builtin types."""
+    if value is None or value.__class__ in (int, float, str):
+        return value
+    if isinstance(value, Decimal):
+        return ('Decimal', str(value))
+    if isinstance(value, Value):
+        return (value.__class__.__name__, _encode_value(value.value),
+                value._assign)
+    if isinstance(value, (list, tuple)):
+        return ('list', [_encode_value(v) for v in value])
+    raise TypeError("Unknown data type: {0!r}".format(value))
+
+
+def _decode_value(data):
+    """Create an argument value from :func:`_encode_value`."""
+    if data.__class__ is not tuple:
+        return data
+    kind = data[0]
+    if kind == 'Decimal':
+        return Decimal(data[1])
+    if kind == 'list':
+        return [_decode_value(v) for v in data[1]]
+    value = data[1]
+    if value.__class__ is tuple:
+        value = _decode_value(value)
+    return _value_types[kind](value, data[2])
+
+
+_value_types = dict((cls.__name__, cls) for cls in
+                    (Value, Array, Symbolic, Identifier, Composed))
 
 
 #----------------------------------------
@@ -914,40 +3258,274 @@ class Document(list):
         """Store the list of nodes."""
         self._nodes = list(nodes)
 
-    def transform(self, node_transform):
-        """Create a new transformed document using the node_transform."""
-        defs = dicti()
-        return Document(node_transform(node, defs)
-                        for node in self._nodes)
+    def transform(self, node_transform, jobs=1, select=None):
+        """
+        Create a new transformed document using the node_transform.
+
+        :param node_transform: callable ``(node, defs)`` returning a node
+        :param int jobs: number of worker processes for sequences, ``None``
+                         to use all processors. ``1`` transforms everything
+                         in the current process.
+        :param select: glob patterns of the sequence names to transform,
+                       ``None`` for all. Other sequences are left out of
+                       the result; all other nodes are kept.
+
+        In parallel mode non-sequence nodes are still transformed in order
+        in the current process. ``node_transform`` is sent to each worker
+        once when it starts, each sequence is sent together with a snapshot
+        of the definitions it references. Both must be picklable.
+        """
+        defs = Definitions()
+        nodes = _select_sequences(self._nodes, select)
+        if jobs == 1:
+            return Document(node_transform(node, defs) for node in nodes)
+        from concurrent.futures import ProcessPoolExecutor, Future
+        with ProcessPoolExecutor(jobs, initializer=_init_worker,
+                                 initargs=(node_transform,)) as pool:
+            nodes = [pool.submit(_transform_sequence, node,
+                                 _sequence_defs(node, defs))
+                     if isinstance(node, Sequence) else
+                     node_transform(node, defs)
+                     for node in nodes]
+            return Document(node.result() if isinstance(node, Future) else node
+                            for node in nodes)
+
+    @classmethod
+    def parse(cls, lines, columnar=False, select=None):
+        """
+        Parse sequence from line iteratable.
+
+        :param lines: line iterable
+        :param bool columnar: store sequences as :class:`ColumnarSequence`
+        :param select: see :meth:`parse_lines`
+        """
+        return cls(cls.iterparse(lines, columnar, select))
+
+    @classmethod
+    def iterparse(cls, lines, columnar=False, select=None):
+        """
+        Parse nodes lazily from line iteratable.
+
+        :param lines: line iterable
+        :param bool columnar: store sequences as :class:`ColumnarSequence`
+        :param select: see :meth:`parse_lines`
+        :returns: Text/Element/Sequence nodes
+        :rtype: generator
+        """
+        nodes = Sequence.detect(cls.parse_lines(lines, select))
+        if columnar:
+            nodes = _columnar(nodes)
+        return nodes
+
+    @classmethod
+    def load(cls, stream, fmt='json', names=None, lazy=False):
+        """
+        Load sequences from the JSON, YAML or binary output of :meth:`dump`.
+
+        The structured formats contain only sequences, so the definitions
+        of their element types must be added before transforming them
+        again, e.g. ``Document(definitions._nodes + loaded._nodes)``.
+
+        JSON and YAML do not distinguish quoted strings from expressions or
+        ``=`` from ``:=``, so all strings are loaded as expressions assigned
+        with ``=``. The binary format keeps the value types, but stores
+        numbers as 64 bit floats. Numbers with fractional part are loaded as
+        :class:`Decimal` in all cases.
+
+        :param stream: file object, opened in binary mode for 'binary'
+        :param str fmt: either 'json', 'yaml' or 'binary'
+        :param names: names or glob patterns of the sequences to load,
+                      ``None`` for all
+        :param bool lazy: create the elements of a sequence only when its
+                          body is iterated (see :class:`LazySequence`)
+        :rtype: Document
+        """
+        if fmt == 'json':
+            sequences = _iter_states(Json().load(stream, parse_float=Decimal))
+        elif fmt == 'yaml':
+            sequences = _iter_states(Yaml().load(stream, exact=True))
+        elif fmt == 'binary':
+            sequences = Binary().iter_sequences(stream.read())
+        else:
+            raise ValueError("Invalid format code: {0!r}".format(fmt))
+        nodes = []
+        for name, state, elements in sequences:
+            if names is not None and not _matches(name, names):
+                continue
+            head = Element(name, 'sequence', ArgDict(
+                (key, _load_value(value)) for key, value in state.items()))
+            tail = Element(None, 'endsequence', ArgDict())
+            generate = partial(_load_elements, elements)
+            if lazy:
+                nodes.append(LazySequence(head, generate, tail))
+            else:
+                nodes.append(Sequence([head] + generate() + [tail]))
+        return cls(nodes)
 
     @classmethod
-    def parse(cls, lines):
-        """Parse sequence from line iteratable."""
-        return cls(Sequence.detect(chain.from_iterable(map(cls.parse_line, lines))))
+    def stream(cls, lines, node_transform, stream, fmt='madx',
+               columnar=False, buffer_size=2**16, style=None, select=None):
+        """
+        Parse, transform and serialize without keeping the whole document.
+
+        Nodes are passed one at a time through the parser, the transformation
+        and the output, so memory usage is bounded by the largest sequence
+        rather than the size of the input.
+
+        :param lines: line iterable, e.g. a file object
+        :param node_transform: node transformation, see :meth:`transform`
+        :param stream: output file object
+        :param str fmt: either 'madx', 'yaml', 'json' or 'binary'
+        :param bool columnar: store sequences as :class:`ColumnarSequence`
+        :param int buffer_size: see :meth:`dump`
+        :param str style: see :meth:`dump`
+        :param select: see :meth:`transform`
+        """
+        defs = Definitions()
+        # prefer emitting slices lazily if the transformation supports it:
+        transform = getattr(node_transform, 'lazy', node_transform)
+        nodes = (transform(node, defs)
+                 for node in _select_sequences(
+                     cls.iterparse(lines, columnar, select), select))
+        cls._dump(nodes, stream, fmt, buffer_size, style)
 
     @classmethod
     def parse_line(cls, line):
         """
         Parse a single-line MAD-X input statement.
 
-        Return an iterable that iterates over parsed elements.
+        Same as :meth:`parse_lines` for a single line, but returns a list
+        instead of setting up a generator for each line.
+
+        :param str line: input line
+        :returns: Text/Element nodes
+        :rtype: list
+        :raises ValueError: if the last statement is not terminated
+        """
+        if type(line) is Text:
+            return [line]
+        code, comment = split_comment(line)
+        nodes = [] if comment is None else [Text(comment)]
+        commands = split_statements(code.strip())
+        last = commands.pop()
+        nodes.extend(map(cls._parse_command, commands))
+        if last:
+            if not is_block_delimiter(last):
+                raise ValueError("Unterminated statement: %s" % last)
+            nodes.append(Text(last))
+        elif not commands and comment is None:
+            nodes.append(Text(''))
+        return nodes
 
-        TODO: Does not support multi-line commands yet!
+    @classmethod
+    def parse_lines(cls, lines, select=None):
+        """
+        Parse MAD-X input statements that may span multiple lines.
+
+        The code of an unterminated statement is collected as a list of
+        fragments that is joined only once the terminating semicolon is
+        found, so the cost stays linear in the length of the statement.
+        Comments are emitted before the statements of their line.
+
+        Lines that were already recognized as blank or comment-only lines
+        can be passed as :class:`Text` (see :func:`mapped_lines`), which
+        skips splitting them.
+
+        With ``select``, a sequence whose name matches none of the patterns
+        is returned as a single :class:`Text` node with its unparsed lines
+        up to ``ENDSEQUENCE``. Only lines that contain the word
+        ``endsequence`` are split into statements. This applies to
+        sequence headers that are the last statement on their line, other
+        sequences are parsed as usual.
+
+        :param lines: line iterable
+        :param select: glob patterns of the sequence names to parse,
+                       ``None`` for all
+        :returns: Text/Element nodes
+        :rtype: generator
+        :raises ValueError: if the last statement is not terminated
         """
-        code, comment = regex.comment_split.match(line).groups()
-        if comment:
-            yield Text(comment)
-        commands = list(code.strip().split(';'))
-        if commands[-1]:
+        pending = []        # fragments of the unterminated statement
+        skipped = None      # lines of an unselected sequence
+        for line in lines:
+            if skipped is not None:
+                if (type(line) is Text or
+                        not regex.has_sequence_end.search(line)):
+                    skipped.append(line.rstrip('\n'))
+                    continue
+                code, comment = split_comment(line)
+                commands = split_statements(code.strip())
+                end = next((i+1 for i, command in enumerate(commands[:-1])
+                            if regex.sequence_end.match(command)), None)
+                if end is None:
+                    skipped.append(line.rstrip('\n'))
+                    continue
+                if end == len(commands) - 1 and not commands[-1].strip():
+                    skipped.append(line.rstrip('\n'))
+                    yield Text('\n'.join(skipped))
+                    skipped = None
+                    continue
+                # statements follow on the line of the ENDSEQUENCE:
+                skipped.extend(command.strip() + ';'
+                               for command in commands[:end])
+                yield Text('\n'.join(skipped))
+                skipped = None
+                line = ';'.join(commands[end:]) + (comment or '')
+            if type(line) is Text:
+                # blank lines inside a statement are dropped:
+                if line or not pending:
+                    yield line
+                continue
+            code, comment = split_comment(line)
+            if comment is not None:
+                yield Text(comment)
+            commands = split_statements(code.strip())
+            last = commands.pop()
+            for index, command in enumerate(commands):
+                if pending:
+                    pending.append(command)
+                    fragments, pending = pending, []
+                else:
+                    fragments = [command]
+                if (select is not None and not last and
+                        index == len(commands) - 1 and
+                        _skip_sequence(' '.join(fragments), select)):
+                    if len(commands) == len(fragments) == 1 and not comment:
+                        skipped = [line.rstrip('\n')]
+                    else:
+                        skipped = ['\n'.join(fragments).strip() + ';']
+                elif len(fragments) > 1:
+                    yield cls._parse_fragments(fragments)
+                else:
+                    yield cls._parse_command(command)
+            if last:
+                if not pending and is_block_delimiter(last):
+                    yield Text(last)
+                else:
+                    pending.append(last)
+            elif not commands and comment is None and not pending:
+                yield Text('')
+        if skipped is not None:
+            yield Text('\n'.join(skipped))
+        if pending:
             raise ValueError(
-                "Not accepting multi-line commands: %s" % commands[-1])
-        for command in commands[:-1]:
-            try:
-                yield Element.parse(command + ';')
-            except AttributeError:
-                yield Text(command + ';')
-        if len(commands) == 1 and not comment:
-            yield Text('')
+                "Unterminated statement: %s" % '\n'.join(pending))
+
+    @staticmethod
+    def _parse_command(command):
+        """Parse a single-line statement as Element or Text."""
+        elem = Element.parse_statement(command)
+        if elem is None:
+            return Text(command + ';')
+        return elem
+
+    @staticmethod
+    def _parse_fragments(fragments):
+        """Parse a multi-line statement as Element or Text."""
+        elem = Element.parse_statement(' '.join(fragments))
+        if elem is None:
+            return Text('\n'.join(fragments) + ';')
+        return elem
 
     def _getstate(self):
         """Get a serializeable state for :class:`Json` and :class:`Yaml`."""
@@ -955,27 +3533,294 @@ class Document(list):
             (seq.name, odicti(
                 list(seq.head.args.items()) +
                 [('elements', [elem._getstate()
-                               for elem in seq.body
+                               for elem in seq.iter_body()
                                if elem.type])]
             ))
             for seq in self._nodes
             if isinstance(seq, Sequence))
 
-    def dump(self, stream, fmt='madx'):
+    def dump(self, stream, fmt='madx', buffer_size=2**16, style=None):
         """
         Serialize to the stream.
 
-        :param stream: file object
-        :param str fmt: either 'madx', 'yaml' or 'json'
+        :param stream: file object, opened in binary mode for 'binary'
+        :param str fmt: either 'madx', 'yaml', 'json' or 'binary'
+        :param int buffer_size: number of characters to collect before
+                                writing to the stream
+        :param str style: layout of JSON or YAML output, see
+                          :attr:`Json.styles` and :attr:`Yaml.styles`
         """
+        self._dump(self._nodes, stream, fmt, buffer_size, style)
+
+    @staticmethod
+    def _dump(nodes, stream, fmt, buffer_size, style=None):
+        """Serialize nodes one element at a time, see :meth:`dump`."""
         if fmt == 'json':
-            Json().dump(self._getstate(), stream)
+            serializer = Json(style or Json.styles[0])
         elif fmt == 'yaml':
-            Yaml().dump(self._getstate(), stream)
-        elif fmt == 'madx':
-            stream.write("\n".join(map(str, self._nodes)))
-        else:
+            serializer = Yaml(style or Yaml.styles[0])
+        elif fmt == 'binary':
+            # arrays are written in one piece, no need for buffering:
+            Binary().dump_sequences(
+                (node for node in nodes if isinstance(node, Sequence)),
+                stream)
+            return
+        elif fmt != 'madx':
             raise ValueError("Invalid format code: {0!r}".format(fmt))
+        output = BufferedWriter(stream, buffer_size)
+        try:
+            if fmt == 'madx':
+                Document._write_madx(nodes, output)
+            else:
+                # only sequences contribute to the structured formats:
+                serializer.dump_sequences(
+                    (node for node in nodes if isinstance(node, Sequence)),
+                    output)
+        finally:
+            output.flush()
+
+    @staticmethod
+    def _write_madx(nodes, stream):
+        """Write nodes in MAD-X format one line at a time."""
+        sep = ''
+        for node in nodes:
+            if isinstance(node, ColumnarSequence):
+                lines = node.iter_lines()
+            elif isinstance(node, Sequence):
+                lines = node.iter_nodes()
+            else:
+                lines = (node,)
+            for line in lines:
+                stream.write(sep)
+                stream.write(str(line))
+                sep = '\n'
+
+
+def mapped_lines(filename, encoding='utf-8', block_size=2**20):
+    """
+    Read the lines of a file through a read-only memory map.
+
+    The file is decoded one block of about ``block_size`` bytes at a time
+    when the consumer reaches it, so that only the part of the file that is
+    currently being parsed is held in memory as text. Blank lines and lines
+    containing only a comment are yielded as :class:`Text` nodes that
+    :meth:`Document.parse_lines` passes through without further parsing.
+
+    :param str filename: input file name
+    :param str encoding: input file encoding
+    :param int block_size: approximate number of bytes to decode at once
+    :returns: lines (without newline character) and Text nodes
+    :rtype: generator
+    """
+    import mmap
+    blank = Text('')
+    with open(filename, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:      # empty file
+            return
+        try:
+            start, size = 0, len(data)
+            while start < size:
+                end = data.rfind(b'\n', start, start + block_size) + 1
+                if end <= start:
+                    end = data.find(b'\n', start + block_size) + 1 or size
+                text = data[start:end].decode(encoding)
+                if end == size and not text.endswith('\n'):
+                    text += '\n'
+                start = end
+                for line in text.replace('\r\n', '\n').split('\n')[:-1]:
+                    first = line.lstrip()[:2]
+                    if not first:
+                        yield blank
+                    elif first[0] == '!' or first == '//':
+                        yield Text(line.lstrip())
+                    else:
+                        yield line
+        finally:
+            data.close()
+
+
+def _columnar(nodes):
+    """Convert the sequences among the nodes to ColumnarSequence."""
+    for node in nodes:
+        if isinstance(node, Sequence):
+            node = ColumnarSequence.from_sequence(node)
+        yield node
+
+
+def _matches(name, patterns):
+    """Check if the name matches any of the case insensitive glob patterns."""
+    from fnmatch import fnmatchcase
+    name = str(name).lower()
+    return any(fnmatchcase(name, str(pattern).lower())
+               for pattern in patterns)
+
+
+def _select_sequences(nodes, patterns):
+    """Replace sequences matching none of the patterns by their MAD-X text."""
+    if patterns is None:
+        return nodes
+    return (Text(node) if isinstance(node, Sequence) and
+            not _matches(node.name, patterns) else node
+            for node in nodes)
+
+
+def _skip_sequence(statement, patterns):
+    """Check if a statement opens a sequence matching none of the patterns."""
+    match = regex.sequence_head.match(statement)
+    return match is not None and not _matches(match.group(1), patterns)
+
+
+def _iter_states(data):
+    """Split the loaded state of a document like Binary.iter_sequences."""
+    for name, state in data.items():
+        state = odicti(state)
+        elements = state.pop('elements', [])
+        yield name, state, partial(_split_states, elements)
+
+
+def _split_states(elements):
+    """Get name, type, argument names and values of element states."""
+    result = []
+    for state in elements:
+        items = [(key, value) for key, value in state.items()
+                 if key.lower() not in ('name', 'type')]
+        result.append((state.get('name'), state['type'],
+                       [key for key, value in items],
+                       [value for key, value in items]))
+    return result
+
+
+def _load_elements(elements):
+    """Create the elements of a sequence from their loaded arguments."""
+    return [Element(name, type, ArgDict._from_lists(
+                [key.lower() for key in keys], keys,
+                [_load_value(value) for value in values]))
+            for name, type, keys, values in elements()]
+
+
+def _load_value(value):
+    """Restore the type of an argument value loaded by Document.load."""
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    if isinstance(value, list):
+        return Array([_load_value(item) for item in value])
+    if isinstance(value, str) and not isinstance(value, Value):
+        parsed = Value.parse(value)
+        return parsed if isinstance(parsed, Value) else value
+    return value
+
+
+# node transform of a worker process, see Document.transform:
+_worker_transform = None
+
+
+def _init_worker(node_transform):
+    """Store the node transform when a worker process starts."""
+    global _worker_transform
+    _worker_transform = node_transform
+
+
+def _transform_sequence(seq, defs):
+    """Transform a sequence in a worker process."""
+    return _worker_transform(seq, defs)
+
+
+def _sequence_defs(seq, defs):
+    """Get the subset of the definitions referenced in a sequence body."""
+    return Definitions((str(elem.type), defs.resolve(elem.type))
+                       for elem in seq.iter_body()
+                       if elem.type and elem.type in defs)
+
+
+class IncrementalOutput(object):
+
+    """
+    Reuse the MAD-X output of sequences whose inputs did not change.
+
+    :ivar str manifest: file name of the manifest
+    :ivar str fragments: directory for the MAD-X output of the sequences
+
+    The manifest lists every sequence with a fingerprint of its inputs (see
+    :meth:`SequenceTransform.fingerprint`), the definitions it uses and the
+    number of slicing rules it depends on. The output of each sequence is
+    stored in the fragments directory under its fingerprint.
+    """
+
+    def __init__(self, output):
+        """Store the manifest and fragments next to the output file."""
+        self.manifest = output + '.manifest'
+        self.fragments = output + '.fragments'
+
+    def transform(self, document, node_transform, select=None):
+        """
+        Transform the document, reusing the output of unchanged sequences.
+
+        :param Document document: parsed document
+        :param SequenceTransform node_transform:
+        :param select: see :meth:`Document.transform`
+        :returns: document with sequences replaced by their MAD-X output
+        :rtype: Document
+        """
+        import os
+        known = set(entry['fingerprint'] for entry in self._load_manifest())
+        if not os.path.isdir(self.fragments):
+            os.makedirs(self.fragments)
+        defs = Definitions()
+        entries = []
+        nodes = []
+        for node in _select_sequences(document._nodes, select):
+            if isinstance(node, Sequence):
+                key, names, rules = node_transform.fingerprint(node, defs)
+                entries.append(odicti([('name', str(node.name)),
+                                       ('fingerprint', key),
+                                       ('definitions', names),
+                                       ('rules', rules)]))
+                node = self._fragment(key, key in known, node_transform,
+                                      node, defs)
+            else:
+                node = node_transform(node, defs)
+            nodes.append(node)
+        self._save_manifest(entries)
+        return Document(nodes)
+
+    def _fragment(self, key, known, node_transform, node, defs):
+        """Load or create the MAD-X output of a sequence as Text."""
+        import os
+        filename = os.path.join(self.fragments, key + '.madx')
+        if known:
+            try:
+                with open(filename, 'rt') as f:
+                    return Text(f.read())
+            except (IOError, OSError):
+                pass
+        text = Text(node_transform(node, defs))
+        with open(filename, 'wt') as f:
+            f.write(text)
+        return text
+
+    def _load_manifest(self):
+        """Get the sequence entries of the previous run."""
+        try:
+            with open(self.manifest) as f:
+                manifest = Json().load(f)
+        except (IOError, OSError, ValueError):
+            return []
+        if manifest.get('version') != __version__:
+            return []
+        return manifest['sequences']
+
+    def _save_manifest(self, entries):
+        """Save the sequence entries and remove unused fragments."""
+        import os
+        with open(self.manifest, 'wt') as f:
+            Json().dump(odicti([('version', __version__),
+                                ('sequences', entries)]), f)
+        used = set(entry['fingerprint'] + '.madx' for entry in entries)
+        for name in os.listdir(self.fragments):
+            if name.endswith('.madx') and name not in used:
+                os.remove(os.path.join(self.fragments, name))
 
 
 def main(argv=None):
@@ -984,40 +3829,89 @@ def main(argv=None):
     from docopt import docopt
     args = docopt(__doc__, argv, version=__version__)
 
-    # perform input
+    # check options
+    if args['--incremental'] and (args['--json'] or args['--yaml'] or
+                                  args['--binary'] or
+                                  args['--stream'] or
+                                  args['<output>'] in (None, '-')):
+        raise SystemExit("--incremental needs a MAD-X <output> file")
+    if args['--incremental'] and args['--jobs'] != '1':
+        raise SystemExit("--incremental can not be used with --jobs")
+
+    # files to close at the end:
+    opened = []
+
+    # open input stream
     if args['<input>'] and args['<input>'] != '-':
-        with open(args['<input>'], 'rt') as f:
-            input_file = list(f)
+        if args['--mmap'] and not args['--cache']:
+            input_file = mapped_lines(args['<input>'])
+        else:
+            input_file = open(args['<input>'], 'rt')
+        opened.append(input_file)
     else:
         from sys import stdin as input_file
 
-    # open output stream
-    if args['<output>'] and args['<output>'] != '-':
-        output_file = open(args['<output>'], 'wt')
-    else:
-        from sys import stdout as output_file
-
-    # get slicing definition
-    if args['--slice']:
-        with open(args['--slice']) as f:
-            if args['--slice'][-5:].lower() == '.json':
-                transforms_doc = Json().load(f)
+    try:
+        # open output stream
+        mode = 'wb' if args['--binary'] else 'wt'
+        if args['<output>'] and args['<output>'] != '-':
+            output_file = open(args['<output>'], mode)
+            opened.append(output_file)
+        elif args['--binary']:
+            output_file = getattr(sys.stdout, 'buffer', sys.stdout)
+        else:
+            from sys import stdout as output_file
+
+        # get slicing definition
+        if args['--slice']:
+            with open(args['--slice']) as f:
+                if args['--slice'][-5:].lower() == '.json':
+                    transforms_doc = Json().load(f)
+                else:
+                    transforms_doc = Yaml().load(f)
+        else:
+            transforms_doc = []
+        node_transform = SequenceTransform(transforms_doc,
+                                           arithmetic=args['--numeric'])
+
+        # output format
+        if args['--json']:
+            fmt = 'json'
+        elif args['--yaml']:
+            fmt = 'yaml'
+        elif args['--binary']:
+            fmt = 'binary'
+        else:
+            fmt = 'madx'
+
+        # one line to do it all:
+        columnar = args['--columnar']
+        select = None
+        if args['--select'] is not None:
+            select = [pattern.strip()
+                      for pattern in args['--select'].split(',')
+                      if pattern.strip()]
+        if args['--stream']:
+            Document.stream(input_file, node_transform, output_file, fmt,
+                            columnar, style=args['--style'], select=select)
+        else:
+            jobs = int(args['--jobs']) or None
+            if args['--cache']:
+                cache = ParseCache(args['--cache'],
+                                   int(args['--cache-size']) * 2**20)
+                document = cache.parse(input_file.read(), columnar)
             else:
-                transforms_doc = Yaml().load(f)
-    else:
-        transforms_doc = []
-    node_transform = SequenceTransform(transforms_doc)
-
-    # output format
-    if args['--json']:
-        fmt = 'json'
-    elif args['--yaml']:
-        fmt = 'yaml'
-    else:
-        fmt = 'madx'
-
-    # one line to do it all:
-    Document.parse(input_file).transform(node_transform).dump(output_file, fmt)
+                document = Document.parse(input_file, columnar, select)
+            if args['--incremental']:
+                incremental = IncrementalOutput(args['<output>'])
+                document = incremental.transform(document, node_transform,
+                                                 select)
+            else:
+                document = document.transform(node_transform, jobs, select)
+            document.dump(output_file, fmt, style=args['--style'])
+    finally:
+        for f in opened:
+            f.close()
 main.__doc__ = __doc__
 
 
@@ -27,6 +27,7 @@ setup(
     url='https://github.com/hibtc/madseq',
     license='MIT',
     py_modules=['madseq'],
+    python_requires='>=3.7',
     entry_points={
         'console_scripts': [
             'madseq = madseq:main'
@@ -38,7 +39,8 @@ setup(
     ],
     extras_require={
         'yaml': ['PyYAML'],
-        'slice': ['PyYAML']
+        'slice': ['PyYAML'],
+        'numpy': ['numpy'],
     },
     test_suite='nose.collector',
     tests_require=['nose'],
@@ -49,6 +51,8 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
         'Topic :: Scientific/Engineering :: Medical Science Apps.',
         'Topic :: Scientific/Engineering :: Physics'
     ],
@@ -0,0 +1,58 @@
+# test utilities
+import os
+import sys
+import unittest
+
+from io import StringIO
+
+# tested module
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'bench'))
+import bench
+import drift
+import madseq
+
+
+class Test_Bench(unittest.TestCase):
+
+    def test_generate(self):
+        stream = StringIO()
+        bench.generate(stream, sequences=2, elements=7, depth=3, args=5)
+        document = madseq.Document.parse(stream.getvalue().splitlines())
+        sequences = [node for node in document._nodes
+                     if isinstance(node, madseq.Sequence)]
+        self.assertEqual([seq.name for seq in sequences], ['seq0', 'seq1'])
+        self.assertEqual(len(sequences[0].body), 7)
+        elem = sequences[1].body[0]
+        self.assertEqual(elem.type, 'quadrupole2')
+        self.assertEqual(list(elem.args)[1:], ['p0', 'p1', 'p2', 'p3', 'p4'])
+        self.assertEqual(elem['p2'].expr, 'kq1*1.5')
+
+    def test_run(self):
+        stream = StringIO()
+        bench.generate(stream, sequences=1, elements=12, depth=1, args=1)
+        lines = stream.getvalue().splitlines(True)
+        for style in bench.rule_styles:
+            results = bench.run(lines, bench.slicing(style), 12,
+                                ['madx', 'binary'])
+            self.assertEqual(sorted(results), ['detect', 'dump_binary',
+                                               'dump_madx', 'parse_lines',
+                                               'transform'])
+            self.assertTrue(results['dump_madx']['size'] > 0)
+            self.assertTrue(results['transform']['peak_memory'] > 0)
+        self.assertRaises(ValueError, bench.slicing, 'thin')
+
+    def test_drift(self):
+        stream = StringIO()
+        bench.generate(stream, sequences=1, elements=30, depth=1, args=0)
+        lines = stream.getvalue().splitlines(True)
+        results = drift.compare(lines, 3, ['decimal', 'float', 'fixed'])
+        self.assertEqual(results['decimal']['at'],
+                         {'max': 0.0, 'mean': 0.0, 'differences': 0})
+        for name in ('float', 'fixed'):
+            self.assertTrue(results[name]['at']['max'] < 1e-9)
+            self.assertTrue(results[name]['L']['max'] < 1e-9)
+        self.assertTrue(results['float']['L']['differences'] > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
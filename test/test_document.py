@@ -25,6 +25,423 @@ class Test_Document(unittest.TestCase):
                           Element(None, 'use', {'z': Decimal('23.23e2')}),
                           Element('k', 'z', {})])
 
+        self.assertEqual(parse('while (i < 2) {'), ['while (i < 2) {'])
+        self.assertRaises(ValueError, parse, 'q: quadrupole,')
+
+    def test_parse_lines(self):
+
+        parse = madseq.Document.parse_lines
+        Element = madseq.Element
+
+        self.assertEqual(list(parse(['q: quadrupole, ! first\n',
+                                     '   k1=2, // second\n',
+                                     '\n',
+                                     '   l=1; d: drift;\n'])),
+                         ['! first',
+                          '// second',
+                          Element('q', 'quadrupole', {'k1': 2, 'l': 1}),
+                          Element('d', 'drift', {})])
+
+        self.assertEqual(list(parse(['x = "a;b!c"; ! "comment\n'])),
+                         ['! "comment',
+                          'x = "a;b!c";'])
+
+        self.assertEqual(list(parse(['while (i < 2) {\n',
+                                     'i = i + 1;\n',
+                                     '}\n'])),
+                         ['while (i < 2) {',
+                          'i = i + 1;',
+                          '}'])
+
+        self.assertRaises(ValueError, list, parse(['q: quadrupole,\n']))
+
+    def test_parse_lines_long(self):
+        lines = ['m: multipole, knl={\n']
+        lines += ['%d,\n' % i for i in range(10000)]
+        lines += ['0};\n']
+        elem, = madseq.Document.parse_lines(lines)
+        self.assertEqual(len(elem['knl'].value), 10001)
+
+    def test_mapped_lines(self):
+        import os, tempfile
+        text = ('q: quadrupole, ! first\r\n'
+                '   k1=2; // second\n'
+                '\n'
+                '  ! "comment"; x=1\n'
+                'x = "a;b!c";')
+        fd, filename = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(text.encode('utf-8'))
+            lines = list(madseq.mapped_lines(filename, block_size=8))
+            nodes = madseq.Document.parse_lines(lines)
+            expected = madseq.Document.parse_lines(text.splitlines())
+            self.assertEqual(lines[2:4], ['', '! "comment"; x=1'])
+            self.assertTrue(isinstance(lines[2], madseq.Text))
+            self.assertEqual(list(nodes), list(expected))
+        finally:
+            os.remove(filename)
+
+    def test_dump(self):
+        import io
+        text = ('q: quadrupole, l=1, k1:=kq, knl={0, 1}, s="x";\n'
+                'e: sequence, l=4, refer=entry;\n'
+                'endsequence;\n'
+                's: sequence, l=4;\n'
+                'q, at=1;\n'
+                'q, at=2, tilt=0.5;\n'
+                'endsequence;\n')
+        document = madseq.Document.parse(text.splitlines(True))
+        for fmt, serializer in [('json', madseq.Json()),
+                                ('yaml', madseq.Yaml())]:
+            expected = io.StringIO()
+            serializer.dump(document._getstate(), expected)
+            output = io.StringIO()
+            document.dump(output, fmt, buffer_size=16)
+            self.assertEqual(output.getvalue(), expected.getvalue())
+        empty = io.StringIO()
+        madseq.Document([]).dump(empty, 'json')
+        self.assertEqual(empty.getvalue(), '{}')
+
+    def test_dump_json_styles(self):
+        import io, json
+        text = ('q: quadrupole, l=1;\n'
+                's: sequence, l=4;\n'
+                'q, at=0.1000000000000000000001, knl={0, 1.25};\n'
+                'endsequence;\n')
+        document = madseq.Document.parse(text.splitlines(True))
+        pretty = io.StringIO()
+        document.dump(pretty, 'json')
+        self.assertTrue('"at" : 0.1000000000000000000001' in pretty.getvalue())
+        compact = io.StringIO()
+        document.dump(compact, 'json', style='compact')
+        self.assertEqual(json.loads(compact.getvalue()),
+                         json.loads(pretty.getvalue()))
+        self.assertEqual(compact.getvalue().count('\n'), 0)
+        lines = io.StringIO()
+        document.dump(lines, 'json', style='ndjson')
+        head, elem = map(json.loads, lines.getvalue().splitlines())
+        self.assertEqual(head, {'sequence': 's', 'l': 4})
+        self.assertEqual(elem['knl'], [0, 1.25])
+        self.assertRaises(ValueError, madseq.Json, 'fancy')
+
+    def test_dump_yaml_documents(self):
+        import io, yaml
+        text = ('a: sequence, l=4;\n'
+                'm: multipole, at=1, knl={0, 1.5};\n'
+                'endsequence;\n'
+                'b: sequence, l=2;\n'
+                'endsequence;\n')
+        document = madseq.Document.parse(text.splitlines(True))
+        output = io.StringIO()
+        document.dump(output, 'yaml', style='documents')
+        a, b = yaml.safe_load_all(output.getvalue())
+        self.assertEqual(a['a']['elements'][0]['knl'], [0, 1.5])
+        self.assertEqual(a['a']['elements'][0]['at'], 1.0)
+        self.assertEqual(b, {'b': {'l': 2, 'elements': []}})
+        self.assertTrue(madseq.Yaml()._dumper() is madseq.Yaml()._dumper())
+
+    def test_dump_binary(self):
+        import io, os, tempfile
+        text = ('q: quadrupole, l=1;\n'
+                's: sequence, l=4, refer=entry;\n'
+                'q1: q, at=1.5, k1:=kq*2, knl={0, 1}, file="ü.txt";\n'
+                'q, at=x+1, n=3;\n'
+                'endsequence;\n')
+        document = madseq.Document.parse(text.splitlines(True))
+        stream = io.BytesIO()
+        document.dump(stream, 'binary')
+        stream.seek(0)
+        data = madseq.Binary().load(stream)
+        self.assertEqual(list(data), ['s'])
+        self.assertEqual(data['s']['L'], 4)
+        self.assertEqual(data['s']['refer'].expr, 'entry')
+        first, second = data['s']['elements']
+        self.assertEqual(list(first), ['name', 'type', 'at', 'k1',
+                                       'knl', 'file'])
+        self.assertEqual(first['name'], 'q1')
+        self.assertEqual(first['at'], 1.5)
+        self.assertEqual(first['k1'].argument, ':=kq*2')
+        self.assertEqual(first['knl'].expr, '{0,1}')
+        self.assertEqual(first['file'], 'ü.txt')
+        self.assertEqual(list(second), ['name', 'type', 'at', 'n'])
+        self.assertEqual(second['at'].expr, 'x+1')
+        self.assertEqual(second['n'], 3)
+        fd, filename = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(stream.getvalue())
+            positions = madseq.Binary().positions(filename, 'S')
+            self.assertEqual(positions[0], 1.5)
+            self.assertTrue(positions[1] != positions[1])
+            self.assertRaises(KeyError, madseq.Binary().positions,
+                              filename, 'x')
+        finally:
+            del positions
+            os.remove(filename)
+
+    def test_load(self):
+        import io
+        definitions = ('q: quadrupole, l=1;\n'
+                       'd: drift, l=0.5;\n')
+        sequences = ('s1: sequence, l=4, refer=entry;\n'
+                     'q, at=0.3333333333333333333333;\n'
+                     'd, at=k*2;\n'
+                     'm: multipole, at=2, knl={0, 1.5}, n=3;\n'
+                     'endsequence;\n'
+                     's2: sequence, l=1;\n'
+                     'd, at=0;\n'
+                     'endsequence;\n')
+        document = madseq.Document.parse(
+            (definitions + sequences).splitlines(True))
+        # only the sequences are written and loaded:
+        expected = [str(node) for node in document._nodes
+                    if isinstance(node, madseq.Sequence)]
+        self.assertEqual(len(expected), 2)
+        for fmt in ('json', 'yaml', 'binary'):
+            stream = io.BytesIO() if fmt == 'binary' else io.StringIO()
+            document.dump(stream, fmt)
+            stream.seek(0)
+            loaded = madseq.Document.load(stream, fmt)
+            if fmt == 'binary':
+                # numbers are stored as floats:
+                self.assertEqual(str(loaded._nodes[0].body[0]['at']),
+                                 '0.3333333333333333')
+            else:
+                self.assertEqual([str(node) for node in loaded._nodes],
+                                 expected)
+            elem = loaded._nodes[0].body[1]
+            self.assertTrue(isinstance(elem['at'], madseq.Composed))
+            self.assertTrue(isinstance(loaded._nodes[0].head['refer'],
+                                       madseq.Identifier))
+            stream.seek(0)
+            lazy = madseq.Document.load(stream, fmt, names=['S2'], lazy=True)
+            self.assertEqual(len(lazy._nodes), 1)
+            self.assertTrue(isinstance(lazy._nodes[0], madseq.LazySequence))
+            self.assertEqual(str(lazy._nodes[0]), expected[1])
+
+    def test_load_transform(self):
+        import io
+        text = ('q: quadrupole, l=1;\n'
+                's: sequence, l=4;\n'
+                'q, at=1;\n'
+                'endsequence;\n')
+        node_transform = madseq.SequenceTransform([{'slice': 2}])
+        document = madseq.Document.parse(text.splitlines(True))
+        stream = io.StringIO()
+        document.dump(stream, 'json')
+        stream.seek(0)
+        loaded = madseq.Document.load(stream, 'json')
+        combined = madseq.Document(document._nodes[:1] + loaded._nodes)
+        self.assertEqual(
+            list(map(str, combined.transform(node_transform)._nodes)),
+            list(map(str, document.transform(node_transform)._nodes)))
+
+    def test_transform_select(self):
+        text = ('q: quadrupole, l=1;\n'
+                'ring1: sequence, l=4;\n'
+                'q, at=1;\n'
+                'endsequence;\n'
+                'd: drift, l=1;\n'
+                'ring2: sequence, l=4;\n'
+                'd, at=1;\n'
+                'endsequence;\n'
+                'line: sequence, l=4;\n'
+                'q, at=1;\n'
+                'endsequence;\n')
+        node_transform = madseq.SequenceTransform([{'slice': 2}])
+        document = madseq.Document.parse(text.splitlines(True))
+        full = document.transform(node_transform)._nodes
+        selected = document.transform(node_transform, select=['RING*'])._nodes
+        self.assertEqual([node.name for node in selected
+                          if isinstance(node, madseq.Sequence)],
+                         ['ring1', 'ring2'])
+        self.assertEqual(list(map(str, selected)),
+                         list(map(str, full[:4] + document._nodes[4:])))
+        self.assertTrue(isinstance(selected[4], madseq.Text))
+        selected = document.transform(node_transform, select=['line'])._nodes
+        self.assertEqual(list(map(str, selected)),
+                         list(map(str, document._nodes[:4] + full[4:])))
+
+    def test_parse_select(self):
+        text = ('q: quadrupole, l=1;\n'
+                'ring1: sequence, l=4;\n'
+                'q, at=1;\n'
+                'endsequence;\n'
+                'LINE : Sequence,\n'
+                '  l=4;\n'
+                'q , at = 1; ! endsequence\n'
+                '\n'
+                'q, at=2; endsequence; d: drift, l=1;\n'
+                'ring2: sequence, l=4; ! ring\n'
+                'd, at=1;\n'
+                'endsequence; ! end\n')
+        lines = text.splitlines(True)
+        full = madseq.Document.parse(lines)._nodes
+        nodes = madseq.Document.parse(lines, select=['line'])._nodes
+        self.assertEqual(list(map(str, nodes[:4])), list(map(str, full[:4])))
+        self.assertEqual(nodes[4:], ['! ring',
+                                     'ring2: sequence, l=4;\n'
+                                     'd, at=1;\n'
+                                     'endsequence; ! end'])
+        self.assertTrue(isinstance(nodes[2], madseq.Sequence))
+        nodes = madseq.Document.parse(lines, select=['ring*'])._nodes
+        self.assertEqual(nodes[2], 'LINE : Sequence,\n'
+                                   'l=4;\n'
+                                   'q , at = 1; ! endsequence\n'
+                                   '\n'
+                                   'q, at=2;\n'
+                                   'endsequence;')
+        self.assertTrue(isinstance(nodes[2], madseq.Text))
+        self.assertEqual(list(map(str, nodes[3:])), list(map(str, full[3:])))
+
+    def test_buffered_writer(self):
+        import io
+        stream = io.StringIO()
+        writer = madseq.BufferedWriter(stream, 4)
+        writer.write('ab')
+        self.assertEqual(stream.getvalue(), '')
+        writer.write('cd')
+        self.assertEqual(stream.getvalue(), 'abcd')
+        writer.write('e')
+        writer.flush()
+        self.assertEqual(stream.getvalue(), 'abcde')
+
+
+class Test_ParseCache(unittest.TestCase):
+
+    text = ('! header\n'
+            'q: quadrupole, l=0.5, k1:=kq*2, s="x", knl={0, a};\n'
+            's: sequence, l=2;\n'
+            'q, at=1;\n'
+            'endsequence;\n')
+
+    def setUp(self):
+        import tempfile
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.path)
+
+    def _files(self):
+        import os
+        return sorted(os.listdir(self.path))
+
+    def test_parse(self):
+        cache = madseq.ParseCache(self.path)
+        expected = madseq.Document.parse(self.text.splitlines(True))
+        miss = cache.parse(self.text)
+        self.assertEqual(self._files(), [cache.key(self.text) + '.cache'])
+        hit = cache.parse(self.text)
+        self.assertEqual(list(map(str, miss._nodes)),
+                         list(map(str, expected._nodes)))
+        self.assertEqual(list(map(str, hit._nodes)),
+                         list(map(str, expected._nodes)))
+        elem = hit._nodes[1]
+        self.assertEqual(elem['L'], Decimal('0.5'))
+        self.assertEqual(elem['k1'].argument, ':=kq*2')
+        self.assertTrue(isinstance(hit._nodes[2], madseq.Sequence))
+        columnar = cache.parse(self.text, columnar=True)
+        self.assertTrue(isinstance(columnar._nodes[2],
+                                   madseq.ColumnarSequence))
+
+    def test_evict(self):
+        import os, time
+        cache = madseq.ParseCache(self.path)
+        cache.parse(self.text)
+        first, = self._files()
+        os.utime(os.path.join(self.path, first),
+                 (time.time() - 10, time.time() - 10))
+        size = os.path.getsize(os.path.join(self.path, first))
+        cache.max_size = int(2.5 * size)
+        cache.parse(self.text + '\n')
+        self.assertEqual(len(self._files()), 2)
+        cache.parse(self.text + '\n\n')
+        self.assertEqual(len(self._files()), 2)
+        self.assertFalse(first in self._files())
+
+    def test_evict_temporary(self):
+        import os, time
+        cache = madseq.ParseCache(self.path)
+        for name, age in (('old', 2 * cache.stale_time), ('new', 0)):
+            filename = os.path.join(self.path, name + cache.temp_suffix)
+            open(filename, 'w').close()
+            os.utime(filename, (time.time() - age, time.time() - age))
+        cache.parse(self.text)
+        self.assertEqual(self._files(), [cache.key(self.text) + '.cache',
+                                         'new' + cache.temp_suffix])
+
+    def test_key(self):
+        cache = madseq.ParseCache(self.path)
+        key = cache.key(self.text)
+        cache.format_version += 1
+        self.assertNotEqual(cache.key(self.text), key)
+
+
+class Test_IncrementalOutput(unittest.TestCase):
+
+    text = ('q: quadrupole, l=1;\n'
+            'b: sbend, l=2, angle=0.1;\n'
+            's1: sequence, l=4;\n'
+            'q, at=1;\n'
+            'endsequence;\n'
+            's2: sequence, l=4;\n'
+            'b, at=2;\n'
+            'endsequence;\n')
+
+    slicing = [{'type': 'quadrupole', 'slice': 2},
+               {'type': 'sbend', 'slice': 3}]
+
+    def setUp(self):
+        import os, tempfile
+        self.path = tempfile.mkdtemp()
+        self.output = os.path.join(self.path, 'out.madx')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.path)
+
+    def _run(self, text, slicing):
+        node_transform = madseq.SequenceTransform(slicing)
+        document = madseq.Document.parse(text.splitlines(True))
+        incremental = madseq.IncrementalOutput(self.output)
+        result = incremental.transform(document, node_transform)
+        return [str(node) for node in result._nodes], incremental
+
+    def _expected(self, text, slicing):
+        node_transform = madseq.SequenceTransform(slicing)
+        document = madseq.Document.parse(text.splitlines(True))
+        return [str(node) for node in document.transform(node_transform)._nodes]
+
+    def test_transform(self):
+        import os
+        nodes, incremental = self._run(self.text, self.slicing)
+        self.assertEqual(nodes, self._expected(self.text, self.slicing))
+        with open(incremental.manifest) as f:
+            manifest = madseq.Json().load(f)
+        s1, s2 = manifest['sequences']
+        self.assertEqual(s1['definitions'], ['q'])
+        self.assertEqual(s1['rules'], 1)
+        self.assertEqual(s2['rules'], 2)
+        self.assertEqual(len(os.listdir(incremental.fragments)), 2)
+        # mark the stored output of s1 to see that it is reused:
+        fragment = os.path.join(incremental.fragments,
+                                s1['fingerprint'] + '.madx')
+        with open(fragment, 'a') as f:
+            f.write('! reused')
+        # s1 does not depend on the definition of b or on the second rule:
+        text = self.text.replace('l=2', 'l=3')
+        slicing = self.slicing[:1] + [{'type': 'sbend', 'slice': 4}]
+        nodes, incremental = self._run(text, slicing)
+        self.assertTrue(nodes[2].endswith('! reused'))
+        self.assertEqual(nodes[3], self._expected(text, slicing)[3])
+        self.assertEqual(len(os.listdir(incremental.fragments)), 2)
+        # but it depends on the definition of q:
+        text = text.replace('l=1', 'l=0.5')
+        nodes, incremental = self._run(text, slicing)
+        self.assertEqual(nodes, self._expected(text, slicing))
+
 
 if __name__ == '__main__':
     unittest.main()
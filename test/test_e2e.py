@@ -1,4 +1,5 @@
 # test utilities
+import re
 import unittest
 
 from decimal import Decimal
@@ -10,10 +11,18 @@ else:
 
 from pydicti import odicti
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # tested module
 import madseq
 
 
+arithmetics = [a for a in madseq.number_types if numpy or a != 'numpy']
+
+
 class Test_IntegrationTests(unittest.TestCase):
 
     """
@@ -34,6 +43,22 @@ class Test_IntegrationTests(unittest.TestCase):
         self.assertEqual(output_file.getvalue().splitlines(),
                          cleandoc(output_text).splitlines())
 
+        # the streaming pipeline must produce the same output:
+        stream_file = StringIO()
+        node_transform = madseq.SequenceTransform(slicing or [])
+        madseq.Document.stream(input_file, node_transform, stream_file, 'madx')
+
+        self.assertEqual(stream_file.getvalue(), output_file.getvalue())
+
+        # and the columnar sequence storage:
+        columnar_file = StringIO()
+        node_transform = madseq.SequenceTransform(slicing or [])
+        (madseq.Document.parse(input_file, columnar=True)
+         .transform(node_transform)
+         .dump(columnar_file, 'madx'))
+
+        self.assertEqual(columnar_file.getvalue(), output_file.getvalue())
+
 
     def test_simple_template(self):
 
@@ -83,6 +108,33 @@ class Test_IntegrationTests(unittest.TestCase):
             endsequence;
             """)
 
+    def test_redefinition(self):
+
+        self._check(
+            r"""
+            qq: quadrupole, l=1;
+            qp: qq, k1=2;
+            qq: quadrupole, l=5;
+
+            seq: sequence, refer=centre;
+            qp;
+            qq;
+            endsequence;
+            """,
+
+            None,
+
+            """
+            qq: quadrupole, l=1;
+            qp: qq, k1=2;
+            qq: quadrupole, l=5;
+
+            seq: sequence, refer=centre, L=6;
+            qp, at=0.5;
+            qq, at=3.5;
+            endsequence;
+            """)
+
     def test_simple_slice_thick(self):
 
         self._check(
@@ -177,6 +229,95 @@ class Test_IntegrationTests(unittest.TestCase):
             endsequence;
             """)
 
+    def test_parallel(self):
+
+        input_file = cleandoc(
+            r"""
+            qq: quadrupole, l=1;
+            qp: qq, k1=2;
+
+            s1: sequence, refer=centre;
+            q1: qp;
+            q2: qp, l=2;
+            endsequence;
+
+            qp: qq, k1=3, l=3;
+
+            s2: sequence, refer=entry;
+            q1: qp;
+            endsequence;
+            """).splitlines()
+
+        node_transform = madseq.SequenceTransform([{'type': 'quadrupole',
+                                                    'slice': 3}])
+        document = madseq.Document.parse(input_file)
+
+        serial = StringIO()
+        document.transform(node_transform).dump(serial)
+        parallel = StringIO()
+        document.transform(node_transform, jobs=2).dump(parallel)
+
+        self.assertEqual(parallel.getvalue(), serial.getvalue())
+
+    def test_arithmetic(self):
+
+        input_file = cleandoc(
+            r"""
+            seq: sequence, refer=centre;
+            qp: quadrupole, l=1, at=0.5;
+            endsequence;
+            """).splitlines()
+
+        slicing = [{'type': 'quadrupole', 'slice': 3, 'use': {'at': True}}]
+        positions = {}
+        for arithmetic in arithmetics:
+            node_transform = madseq.SequenceTransform(slicing,
+                                                      arithmetic=arithmetic)
+            output = StringIO()
+            (madseq.Document.parse(input_file)
+             .transform(node_transform)
+             .dump(output))
+            positions[arithmetic] = [
+                float(line.split('at=')[1].rstrip(';'))
+                for line in output.getvalue().splitlines()
+                if 'at=' in line]
+
+        self.assertEqual(len(positions['decimal']), 3)
+        for arithmetic in arithmetics:
+            for got, ref in zip(positions[arithmetic], positions['decimal']):
+                self.assertAlmostEqual(got, ref, places=10)
+
+    def test_symbolic_position(self):
+
+        for arithmetic in arithmetics:
+            node_transform = madseq.SequenceTransform(
+                [{'type': 'quadrupole', 'slice': 2}], arithmetic=arithmetic)
+            output = StringIO()
+            (madseq.Document.parse(["seq: sequence, refer=entry;",
+                                    "qp: quadrupole, l=1, at=pos;",
+                                    "endsequence;"])
+             .transform(node_transform)
+             .dump(output))
+            self.assertTrue(re.search(r'at=\(pos - 0(\.0)?\) \+ 0\.5;',
+                                      output.getvalue()))
+
+    def test_structured_output(self):
+
+        document = madseq.Document.parse(cleandoc(
+            r"""
+            qp: quadrupole, l=1;
+            seq: sequence, refer=entry;
+            qp, at=1;
+            endsequence;
+            """).splitlines())
+        node_transform = madseq.SequenceTransform([])
+        output = StringIO()
+        document.transform(node_transform).dump(output, 'json')
+        data = madseq.Json().load(StringIO(output.getvalue()))
+        self.assertEqual(list(data), ['seq'])
+        self.assertEqual(data['seq']['elements'][0]['type'], 'qp')
+        self.assertEqual(data['seq']['L'], 2)
+
 
 if __name__ == '__main__':
     unittest.main()
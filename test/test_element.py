@@ -49,6 +49,29 @@ class Test_Element(unittest.TestCase):
         self.assertEqual(el, copy)
         self.assertEqual(el.args, copy.args)
 
+    def test_copy_on_write(self):
+        args = madseq.ArgDict([('l', 1), ('k1', 2)])
+        el = madseq.Element('q', 'quadrupole', args)
+        copy = el.copy()
+        # the arguments are shared, but the original is not modified:
+        self.assertTrue(el.args is args)
+        self.assertTrue(copy.args._base[2] is args._values)
+        copy['L'] = 3
+        copy['at'] = 4
+        el['k1'] = 5
+        self.assertFalse(copy.args._base[2] is args._values)
+        self.assertEqual(str(el), 'q: quadrupole, l=1, k1=5;')
+        self.assertEqual(str(copy), 'q: quadrupole, L=3, k1=2, at=4;')
+        # copies of copies share the merged arguments:
+        copy2 = copy.copy()
+        del copy2['l']
+        self.assertTrue(copy2.args._base is copy.args._base)
+        self.assertEqual(str(copy2), 'q: quadrupole, k1=2, at=4;')
+        self.assertEqual(str(copy), 'q: quadrupole, L=3, k1=2, at=4;')
+        self.assertFalse('L' in copy2)
+        copy2['l'] = 6
+        self.assertEqual(list(copy2.args), ['k1', 'at', 'l'])
+
     def test_contains(self):
         el = madseq.Element(None, None, odicti(a=1))
         self.assertTrue('a' in el)
@@ -109,6 +132,31 @@ class Test_Element(unittest.TestCase):
         self.assertNotEqual(el0, madseq.Element('a', 'b', odicti(c=2)))
 
 
+class Test_Definitions(unittest.TestCase):
+
+    def test_resolve(self):
+        defs = madseq.Definitions()
+        el0 = madseq.Element('a', 'quadrupole', odicti(l=1, k1=2))
+        el1 = madseq.Element('b', 'a', odicti(k1=3), el0)
+        defs['a'] = el0
+        defs['B'] = el1
+        flat = defs.resolve('b')
+        self.assertTrue(flat is defs.resolve('B'))
+        self.assertTrue(flat._base is None)
+        self.assertEqual(flat.type, 'quadrupole')
+        self.assertEqual(flat.args, odicti(l=1, k1=3))
+        self.assertEqual(defs.resolve('x'), None)
+
+    def test_redefine(self):
+        defs = madseq.Definitions()
+        defs['a'] = madseq.Element('a', 'drift', odicti(l=1))
+        self.assertEqual(defs.resolve('a')['l'], 1)
+        defs['A'] = madseq.Element('a', 'drift', odicti(l=2))
+        self.assertEqual(defs.resolve('a')['l'], 2)
+        del defs['a']
+        self.assertEqual(defs.resolve('a'), None)
+
+
 class Test_Sequence(unittest.TestCase):
 
     def test_detect(self):
@@ -137,5 +185,71 @@ class Test_Sequence(unittest.TestCase):
                                     "endsequence;"))
 
 
+class Test_ColumnarSequence(unittest.TestCase):
+
+    def setUp(self):
+        self.seq = madseq.Sequence([
+            madseq.Element('seq', 'sequence', odicti(l=3)),
+            madseq.Element('q1', 'quadrupole', odicti([('K1', 2), ('L', 1.5),
+                                                       ('at', 1.0)])),
+            madseq.Text('! comment'),
+            madseq.Element(None, 'marker', odicti()),
+            madseq.Element('q2', 'quadrupole', odicti([('at', madseq.Decimal(2)),
+                                                       ('l', 1.5),
+                                                       ('k1', -2)])),
+            madseq.Element(None, 'endsequence', odicti()),
+        ], [madseq.Text('! preface')])
+
+    def test_roundtrip(self):
+        col = madseq.ColumnarSequence.from_sequence(self.seq)
+        self.assertEqual(len(col), 4)
+        self.assertEqual(col.name, 'seq')
+        self.assertEqual(str(col), str(self.seq))
+        self.assertEqual(str(col.to_sequence()), str(self.seq))
+        self.assertEqual(col.body, self.seq.body)
+        self.assertEqual(list(col.body[0].args), ['K1', 'L', 'at'])
+
+    def test_columns(self):
+        col = madseq.ColumnarSequence.from_sequence(self.seq)
+        # names and types share the string table:
+        self.assertEqual(col._strings.count('quadrupole'), 1)
+        self.assertEqual(len(col._shapes), 3)
+        self.assertEqual(list(col._at), [1.0, None, None, madseq.Decimal(2)])
+        self.assertEqual(list(col._length), [1.5, None, None, 1.5])
+        self.assertEqual(list(col._arg_values), [2, -2])
+
+    def test_names(self):
+        col = madseq.ColumnarSequence(self.seq.head, (), self.seq.tail)
+        names = ['q..0', 'q..1', 'q..01', 'q..', 'q12', 'q12..3', '3',
+                 'q..1e3', 'q..1234567890']
+        col.extend(madseq.Element(name, 'marker', odicti())
+                   for name in names)
+        self.assertEqual([elem.name for elem in col.body], names)
+        self.assertEqual(list(col._numbers), [-1, -1, 1, -1, 12, 12, 3, 3,
+                                              234567890])
+        self.assertEqual(list(col._slice_index), [0, 1, -1, -1, -1, 3, -1,
+                                                  -1, -1])
+        self.assertEqual(col._strings.count('q'), 1)
+
+    def test_number_column(self):
+        Decimal, Fixed = madseq.Decimal, madseq.Fixed
+        values = [None, 1, -2**70, 0.5, Decimal('-1.250'), Decimal('5E+2'),
+                  Decimal('-0.0'), Decimal('1.' + '1' * 20), Decimal(-1) / 3,
+                  Decimal('1.' + '1' * 40), Fixed('0.25'),
+                  madseq.Identifier('pos'), True]
+        column = madseq.NumberColumn(values)
+        self.assertEqual(len(column), len(values))
+        self.assertEqual(list(map(type, column)), list(map(type, values)))
+        self.assertEqual(list(map(str, column)), list(map(str, values)))
+        self.assertEqual(len(column._objects), 5)
+
+    def test_append(self):
+        col = madseq.ColumnarSequence(self.seq.head, (), self.seq.tail)
+        col.append(madseq.Element('d', 'drift', odicti(l=1.0)))
+        self.assertEqual(str(col), ("seq: sequence, l=3;\n"
+                                    "d: drift, l=1.0;\n"
+                                    "endsequence;"))
+
+
 if __name__ == '__main__':
     unittest.main()
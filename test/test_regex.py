@@ -87,6 +87,15 @@ class Test_regex(unittest.TestCase):
         self.assertEqual(self.r.match(', par := (a+b)*c ').groups(),
                          ('par', ':=', '(a+b)*c'))
 
+    def test_arg_token(self):
+        self.assertEqual(self.r.match(', par=val').lastgroup, 'identifier')
+        self.assertEqual(self.r.match(', par := 3 ').lastgroup, 'int')
+        self.assertEqual(self.r.match(', par := 3.2 ').lastgroup, 'float')
+        self.assertEqual(self.r.match(', par = "a, b"').lastgroup, 'string')
+        self.assertEqual(self.r.match(', par = {1, b}').lastgroup, 'array')
+        self.assertEqual(self.r.match(', par := 3.2e').lastgroup, 'thingy')
+        self.assertEqual(self.r.match(', par := a+b ').lastgroup, 'thingy')
+
     def test_comment_split(self):
         self.assertEqual(self.r.match(' text ! comment ! bla').groups(),
                          (' text ', '! comment ! bla'))
@@ -5,6 +5,11 @@ from decimal import Decimal
 
 from pydicti import odicti
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # tested module
 import madseq
 
@@ -19,14 +24,134 @@ class Test_ElementTransform(unittest.TestCase):
         tpl, el, l = transformer.slice(elem, 0, 0)
         self.assertEqual(l, init_l)
 
+    @unittest.skipIf(numpy is None, "numpy not installed")
+    def test_uniform_slice_array(self):
+        elem = madseq.Element('D', 'DRIFT', odicti(l=Decimal('2.5')))
+        scalar = madseq.ElementTransform({'density': 4}, float)
+        vector = madseq.ElementTransform({'density': 4}, float, True)
+        _, expect, expect_len = scalar.slice(elem, 0.25, 0.5)
+        _, slices, length = vector.slice(elem, 0.25, 0.5)
+        expect, slices = list(expect), list(slices)
+        self.assertEqual(len(slices), 10)
+        self.assertEqual(length, expect_len)
+        self.assertEqual([s.name for s in slices], [s.name for s in expect])
+        self.assertEqual([s['at'] for s in slices], [s['at'] for s in expect])
+        self.assertTrue(all(type(s['at']) is float for s in slices))
+
+    def test_slice_length_type(self):
+        elem = madseq.Element('Q', 'QUADRUPOLE',
+                              odicti(l=Decimal('0.3'), k1=Decimal('0.7')))
+        for number in (float, madseq.Fixed, Decimal):
+            transformer = madseq.ElementTransform({'slice': 3}, number)
+            _, slices, length = transformer.slice(elem, number(0), 0)
+            slices = list(slices)
+            self.assertTrue(all(type(s['L']) is number for s in slices))
+            self.assertAlmostEqual(float(slices[0]['L']), 0.1, places=12)
+        transformer = madseq.ElementTransform({'slice': 3, 'makethin': True},
+                                              float)
+        _, slices, length = transformer.slice(elem, 0.0, 0)
+        self.assertAlmostEqual(list(slices)[0]['KNL'][1], 0.07, places=12)
+
     # TODO...
 
 
 class Test_SequenceTransform(unittest.TestCase):
 
-    # TODO...
- 
-    pass
+    def _parse(self, text):
+        return list(madseq.Document.parse(text.splitlines())._nodes)
+
+    def test_match(self):
+        base = madseq.Element('QB', 'Quadrupole', odicti(l=1))
+        transform = madseq.SequenceTransform([
+            {'name': 'q2', 'slice': 1},
+            {'type': 'QUADRUPOLE', 'slice': 2},
+            {'name': 'Q1', 'slice': 3},
+            {'slice': 4},
+            {'type': 'drift', 'slice': 5},
+        ])
+        elems = [madseq.Element('q1', 'qb', odicti(), base),
+                 madseq.Element('Q2', 'qb', odicti(), base),
+                 madseq.Element('q1', 'drift', odicti()),
+                 madseq.Element(None, 'drift', odicti())]
+        for elem in elems:
+            linear = next(t for t in transform._transforms if t.match(elem))
+            self.assertTrue(transform._match(elem) is linear)
+
+    def test_slice_cache(self):
+        nodes = self._parse("qp: quadrupole, l=2, k1=1;\n"
+                            "seq: sequence;\n"
+                            "qp;\n"
+                            "qp;\n"
+                            "qp, k1=2;\n"
+                            "qp;\n"
+                            "endsequence;")
+        transform = madseq.SequenceTransform([{'type': 'quadrupole',
+                                               'slice': 2,
+                                               'makethin': True}])
+        defs = madseq.Definitions()
+        seq = [transform(node, defs) for node in nodes][-1]
+        self.assertEqual(transform.slice_cache.misses, 2)
+        self.assertEqual(transform.slice_cache.hits, 2)
+        self.assertEqual([madseq.format_value(el['knl']) for el in seq.body],
+                         ['{0,1}', '{0,1}', '{0,1}', '{0,1}',
+                          '{0,2}', '{0,2}', '{0,1}', '{0,1}'])
+        self.assertEqual([el['at'] for el in seq.body],
+                         [0.5, 1.5, 2.5, 3.5, 4.5, 5.5, 6.5, 7.5])
+
+    def test_slice_cache_placed(self):
+        nodes = self._parse("qp: quadrupole, l=2, k1=1;\n"
+                            "seq: sequence, refer=entry;\n"
+                            "q1: qp, at=0;\n"
+                            "q2: qp, at=3;\n"
+                            "qp, at=6;\n"
+                            "q3: qp, at=8.5, k1=2;\n"
+                            "endsequence;")
+        transform = madseq.SequenceTransform([{'type': 'quadrupole',
+                                               'slice': 2}])
+        defs = madseq.Definitions()
+        seq = [transform(node, defs) for node in nodes][-1]
+        self.assertEqual(transform.slice_cache.misses, 2)
+        self.assertEqual(transform.slice_cache.hits, 2)
+        self.assertEqual(list(map(str, seq.body)),
+                         ['q1..0: qp, at=0, L=1;',
+                          'q1..1: qp, at=1, L=1;',
+                          'q2..0: qp, at=3, L=1;',
+                          'q2..1: qp, at=4, L=1;',
+                          'qp, at=6, L=1;',
+                          'qp, at=7, L=1;',
+                          'q3..0: qp, at=8.5, k1=2, L=1;',
+                          'q3..1: qp, at=9.5, k1=2, L=1;'])
+
+    def test_lazy(self):
+        nodes = self._parse("qp: quadrupole, l=2;\n"
+                            "seq: sequence, refer=entry;\n"
+                            "q1: qp;\n"
+                            "q2: qp;\n"
+                            "endsequence;")
+        transform = madseq.SequenceTransform([{'name': 'q2',
+                                               'slice': 4,
+                                               'template': True}])
+        defs = madseq.Definitions()
+        eager = [transform(node, defs) for node in nodes]
+        defs = madseq.Definitions()
+        lazy = [transform.lazy(node, defs) for node in nodes]
+        self.assertTrue(isinstance(lazy[-1], madseq.LazySequence))
+        self.assertEqual(lazy[-1].head['L'], 4)
+        self.assertEqual(list(map(str, lazy)), list(map(str, eager)))
+
+
+class Test_LRUCache(unittest.TestCase):
+
+    def test_get(self):
+        cache = madseq.LRUCache(2)
+        self.assertEqual(cache.get('a', lambda: 1), 1)
+        self.assertEqual(cache.get('b', lambda: 2), 2)
+        self.assertEqual(cache.get('a', lambda: 3), 1)
+        self.assertEqual(cache.get('c', lambda: 4), 4)     # evicts 'b'
+        self.assertEqual(cache.get('b', lambda: 5), 5)
+        self.assertEqual(cache.get('a', lambda: 6), 6)
+        self.assertEqual((cache.hits, cache.misses), (1, 5))
+        self.assertEqual(len(cache), 2)
 
 
 class Test_rescale_makethin(unittest.TestCase):
@@ -22,12 +22,87 @@ class Test_stri(unittest.TestCase):
         self.assertNotEqual(stri("HeLLo"), "WOrld")
         self.assertNotEqual("HeLLo", stri("WOrld"))
 
+    def test_pickle(self):
+        import pickle
+        s = pickle.loads(pickle.dumps(madseq.stri("HeLLo")))
+        self.assertTrue(isinstance(s, madseq.stri.cls))
+        self.assertEqual(s, "hello")
+
+    def test_intern(self):
+        stri = madseq.stri
+        self.assertTrue(stri("Drift") is stri("Drift"))
+        self.assertTrue(stri(stri("Drift")) is stri("Drift"))
+        self.assertFalse(stri("Drift") is stri("DRIFT"))
+        self.assertFalse(hasattr(stri("Drift"), "__dict__"))
+
+    def test_intern_evict(self):
+        stri = madseq.stri
+        cls = stri.cls
+        size, interned = cls._intern_size, cls._interned
+        cls._intern_size, cls._interned = 2, type(interned)()
+        try:
+            a, b = stri("A"), stri("B")
+            self.assertTrue(stri("A") is a)
+            c = stri("C")
+            # B was the least recently used:
+            self.assertEqual(list(cls._interned), ["A", "C"])
+            self.assertFalse(stri("B") is b)
+            self.assertEqual(b, "b")
+            self.assertEqual(hash(b), hash("b"))
+            self.assertEqual(c, stri("c"))
+        finally:
+            cls._intern_size, cls._interned = size, interned
+
+    def test_hash(self):
+        stri = madseq.stri
+        self.assertEqual(hash(stri("HeLLo")), hash(stri("hello")))
+        self.assertEqual(hash(stri("HeLLo")), hash("hello"))
+        self.assertTrue(stri("HELLO") in {stri("hello"): 1})
+
     def test___str__(self):
         stri = madseq.stri
         s = "HEllO wORld"
         self.assertEqual('%s' % (stri(s),), s)
 
 
+class Test_ArgDict(unittest.TestCase):
+
+    def test_mapping(self):
+        d = madseq.ArgDict([('L', 1), ('k1', 2)])
+        self.assertEqual(d['l'], 1)
+        self.assertEqual(d.get('K1'), 2)
+        self.assertEqual(d.get('x', 3), 3)
+        self.assertTrue('K1' in d)
+        self.assertFalse('x' in d)
+        self.assertRaises(KeyError, d.__getitem__, 'x')
+        d['at'] = 4
+        d['l'] = 5
+        self.assertEqual(d.items(), [('l', 5), ('k1', 2), ('at', 4)])
+        del d['K1']
+        self.assertEqual(list(d), ['l', 'at'])
+        self.assertEqual(len(d), 2)
+        self.assertEqual(d.pop('AT'), 4)
+        self.assertRaises(KeyError, d.__delitem__, 'at')
+
+    def test_copy(self):
+        d = madseq.ArgDict([('a', 1)])
+        c = d.copy()
+        self.assertTrue(c._values is d._values)
+        c['b'] = 2
+        self.assertEqual(list(d), ['a'])
+        self.assertEqual(list(c), ['a', 'b'])
+        d['a'] = 3
+        self.assertEqual(c['a'], 1)
+
+    def test_eq(self):
+        from pydicti import odicti
+        d = madseq.ArgDict([('A', 1), ('b', 2)])
+        self.assertEqual(d, odicti([('a', 1), ('B', 2)]))
+        self.assertEqual(odicti([('a', 1), ('B', 2)]), d)
+        self.assertNotEqual(d, odicti([('a', 1)]))
+        self.assertNotEqual(d, madseq.ArgDict([('a', 1), ('b', 3)]))
+
+
 class Test_Re(unittest.TestCase):
 
     def test_Re(self):
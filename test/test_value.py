@@ -73,6 +73,33 @@ class Test_Symbolic(unittest.TestCase):
         self._test_composed_expr((1 + pi) / 2, "(1 + pi) / 2")
 
 
+class Test_Fixed(unittest.TestCase):
+
+    def test_init(self):
+        Fixed = madseq.Fixed
+        self.assertEqual(Fixed(3).value, 3 * Fixed.scale)
+        self.assertEqual(Fixed(0.1), Fixed(Decimal('0.1')))
+        self.assertEqual(Fixed(Fixed(2)), 2)
+
+    def test_arithmetic(self):
+        third = madseq.Fixed(1) / 3
+        self.assertEqual(str(third), '0.333333333333')
+        self.assertEqual(third * 3, madseq.Fixed(Decimal('0.999999999999')))
+        self.assertEqual(str(1 - third), '0.666666666667')
+        self.assertEqual(sum([madseq.Fixed('0.1')] * 10, 0), 1)
+        self.assertEqual(str(madseq.Fixed(Decimal('-0.5')) / 2), '-0.25')
+
+    def test_round_div(self):
+        self.assertEqual(madseq._round_div(5, 2), 2)
+        self.assertEqual(madseq._round_div(7, 2), 4)
+        self.assertEqual(madseq._round_div(-7, 2), -4)
+        self.assertEqual(madseq._round_div(5, -2), -2)
+
+    def test_format(self):
+        self.assertEqual(format_value(madseq.Fixed(Decimal('1.50'))), '1.5')
+        self.assertEqual(format_value(madseq.Fixed(-2)), '-2')
+
+
 class test_format_value(unittest.TestCase):
 
     """Test :func:`format_value` for standard types."""
@@ -85,6 +112,12 @@ class test_format_value(unittest.TestCase):
 
     def test_float(self):
         self.assertEqual(format_value(-1.2), '-1.2')
+        value = 0.1 + 0.2
+        self.assertEqual(float(format_value(value)), value)
+
+        class subclass(float):
+            __repr__ = lambda self: 'subclass()'
+        self.assertEqual(format_value(subclass(0.5)), '0.5')
 
     def test_int(self):
         self.assertEqual(format_value(-13), '-13')
@@ -124,6 +157,17 @@ class test_parsing(unittest.TestCase):
         self.assertEqual(parse_args(', a =3, crd := pi'),
                          odicti([('a', 3), ('crd', pi)]))
 
+    def test_tokenize_args(self):
+        text = (', a=1, b := -2.5e1, c=x.y, d="s, t", e={1, x}, f=a+b'
+                ', g=inf, h="open, i=1.5.0')
+        expected = [(key, madseq.Value.parse(val, assign))
+                    for key, assign, val in madseq.regex.arg.findall(text)]
+        tokens = madseq.tokenize_args(text)
+        self.assertEqual([k for k, v in tokens], [k for k, v in expected])
+        for (_, value), (_, expect) in zip(tokens, expected):
+            self.assertEqual(type(value), type(expect))
+            self.assertEqual(str(value), str(expect))
+
 
 if __name__ == '__main__':
     unittest.main()